@@ -18,3 +18,5 @@ __author__ = "Arezqui Belaid"
 __contact__ = "areski@gmail.com"
 __homepage__ = "http://www.areskibelaid.com"
 __docformat__ = "restructuredtext"
+
+default_app_config = 'admin_tools_stats.apps.AdminToolsStatsConfig'
@@ -10,7 +10,8 @@
 #
 from django.contrib import admin
 from django.utils.translation import ugettext_lazy as _
-from admin_tools_stats.models import DashboardStatsCriteria, DashboardStats
+from admin_tools_stats.models import DashboardStatsCriteria, DashboardStats, DashboardStatsMetric, \
+    DashboardStatsJob
 from admin_tools_stats.app_label_renamer import AppLabelRenamer
 AppLabelRenamer(native_app_label=u'admin_tools_stats', app_label=_('Admin Tools Stats')).main()
 
@@ -28,6 +29,14 @@ class DashboardStatsCriteriaAdmin(admin.ModelAdmin):
 admin.site.register(DashboardStatsCriteria, DashboardStatsCriteriaAdmin)
 
 
+class DashboardStatsMetricInline(admin.TabularInline):
+    """
+    Additional metrics computed in the same query as the graph.
+    """
+    model = DashboardStatsMetric
+    extra = 0
+
+
 class DashboardStatsAdmin(admin.ModelAdmin):
     """
     Allows the administrator to view and modify certain attributes
@@ -38,5 +47,20 @@ class DashboardStatsAdmin(admin.ModelAdmin):
     list_filter = ['created_date']
     ordering = ('id', )
     save_as = True
+    inlines = [DashboardStatsMetricInline]
 
 admin.site.register(DashboardStats, DashboardStatsAdmin)
+
+
+class DashboardStatsJobAdmin(admin.ModelAdmin):
+    """
+    Allows the administrator to follow the background computations
+    of the graphs.
+    """
+    list_display = ('id', 'graph_key', 'interval', 'select_box_value', 'user', 'status',
+                    'created_date', 'finished_date')
+    list_filter = ['status', 'created_date']
+    ordering = ('-id', )
+    readonly_fields = ('started_date', 'finished_date')
+
+admin.site.register(DashboardStatsJob, DashboardStatsJobAdmin)
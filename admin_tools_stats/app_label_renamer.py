@@ -40,6 +40,11 @@ class AppLabelRenamer(object):
 
         __copy__ = lambda self: self
         __deepcopy__ = lambda self, memodict: self
+        # pickled as a plain string: the graph configurations are cached
+        # (see ``get_dashboard_stats``), and model instances pickle the app
+        # label of their model, which can't be unpickled as this class
+        # (``__new__`` takes the title)
+        __reduce__ = lambda self: (str, (str(self),))
 
     def rename_app_label(self, f):
         app_label = self.app_label
@@ -0,0 +1,69 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2014 Star2Billing S.L.
+#
+# The Initial Developer of the Original Code is
+# Arezqui Belaid <info@star2billing.com>
+#
+from django.conf import settings
+
+
+DEFAULTS = {
+    # seconds the computed series are cached
+    'CACHE_TIMEOUT': 60 * 5,
+    # seconds the computed series are kept to be served stale while the
+    # stats queries are busy
+    'STALE_CACHE_TIMEOUT': 60 * 60 * 24,
+    # relative accuracy of percentiles on databases without PERCENTILE_CONT
+    'PERCENTILE_ACCURACY': 0.01,
+    # database cost estimate above which graphs are refused, None to disable
+    'MAX_COST': None,
+    # database cost estimate above which graphs are computed in background
+    # only (precompute_dashboard_stats), None to disable
+    'BACKGROUND_COST': None,
+    # seconds the cost estimates are cached
+    'COST_CACHE_TIMEOUT': 60 * 60 * 24,
+    # stats queries running at once across processes, None for no limit
+    'MAX_CONCURRENT_QUERIES': None,
+    # seconds a request without stale series waits for a query slot
+    'QUERY_WAIT_TIMEOUT': 10,
+    # seconds a query slot is held at most (holder died)
+    'QUERY_LEASE_TIMEOUT': 60 * 5,
+    # seconds a background job runs at most before being run again (its
+    # worker died)
+    'JOB_LEASE_TIMEOUT': 60 * 60,
+    # queries run at once by an asynchronous dashboard request
+    'ASYNC_CONCURRENCY': 4,
+    # seconds the processes keep the graphs with realtime counters before
+    # reading them again, and wait before seeding the counters of a graph
+    'REALTIME_GRAPHS_TIMEOUT': 30,
+    # seconds the discovered values of the dynamic criteria are cached
+    'CRITERIA_VALUES_TIMEOUT': 60 * 60,
+    # days of records the values of the dynamic criteria are discovered in
+    'CRITERIA_VALUES_DAYS': 30,
+    # values of a dynamic criteria discovered at most, the most frequent ones
+    # when there are more
+    'CRITERIA_VALUES_LIMIT': 50,
+    # entries of the cache of every process in front of the shared cache,
+    # 0 to disable it
+    'LOCAL_CACHE_SIZE': 1000,
+    # seconds the entries of the process cache are kept at most
+    'LOCAL_CACHE_TIMEOUT': 30,
+    # bytes of the packed series above which they are compressed, None to
+    # never compress them
+    'SERIES_COMPRESS_THRESHOLD': 1024,
+    # token of the metrics exporter (sent as ``Authorization: Bearer <token>``),
+    # None to publish the metrics to the staff users only
+    'METRICS_TOKEN': None,
+    # seconds the configuration errors of the graphs are cached, the
+    # configurations being checked again when changed
+    'CONFIG_ERRORS_TIMEOUT': 60 * 60 * 24,
+}
+
+
+def get_setting(name):
+    """Returns the ``ADMIN_TOOLS_STATS_<name>`` setting or its default"""
+    return getattr(settings, 'ADMIN_TOOLS_STATS_%s' % name, DEFAULTS[name])
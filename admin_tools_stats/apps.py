@@ -0,0 +1,22 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2014 Star2Billing S.L.
+#
+# The Initial Developer of the Original Code is
+# Arezqui Belaid <info@star2billing.com>
+#
+from django.apps import AppConfig
+from django.core.signals import request_started
+
+
+class AdminToolsStatsConfig(AppConfig):
+    name = 'admin_tools_stats'
+
+    def ready(self):
+        # the receivers of the realtime counters are connected to the models
+        # of the realtime graphs, read when the requests start
+        from admin_tools_stats.realtime import load_realtime_graphs
+        request_started.connect(load_realtime_graphs, dispatch_uid='admin_tools_stats_realtime_graphs')
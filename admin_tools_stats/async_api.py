@@ -0,0 +1,136 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2014 Star2Billing S.L.
+#
+# The Initial Developer of the Original Code is
+# Arezqui Belaid <info@star2billing.com>
+#
+"""Asynchronous data path of the dashboard, for ASGI deployments (Python 3).
+
+``fetch_dashboard_charts`` reads the cached series of all the charts at once
+(natively asynchronous on Django >= 4.0 caches), then runs the queries of
+the missing ones concurrently, each in its own thread, with at most
+``ADMIN_TOOLS_STATS_ASYNC_CONCURRENCY`` of them at once. The charts
+aggregating the same records still share their query, see
+``DashboardStatsBatch``.
+
+``dashboard_data`` is the asynchronous view returning them as JSON
+(Django >= 3.1, ``admin_tools_stats.urls``).
+"""
+import asyncio
+import time
+
+import django
+from django.core.cache import cache
+from django.db import connections
+from django.http import JsonResponse
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:
+    sync_to_async = None
+
+from admin_tools_stats.app_settings import get_setting
+from admin_tools_stats.batch import DashboardStatsBatch
+from admin_tools_stats.cache import decode_series_many, get_series_many, set_series_many
+from admin_tools_stats.modules import DashboardCharts, DashboardHeatmap, get_active_graph
+
+# whether Django runs ``async def`` views
+ASYNC_VIEWS = sync_to_async is not None and django.VERSION >= (3, 1)
+
+
+def _in_thread(function):
+    """Runs ``function`` in a thread of its own, closing its database connections"""
+    def run(*args):
+        try:
+            return function(*args)
+        finally:
+            connections.close_all()
+    return sync_to_async(run, thread_sensitive=False)
+
+
+async def aget_series_many(keys):
+    """Asynchronous ``get_series_many``"""
+    if hasattr(cache, 'aget_many'):  # Django >= 4.0
+        return decode_series_many(await cache.aget_many(keys))
+    return await sync_to_async(get_series_many)(keys)
+
+
+def _get_batch(select_box_values):
+    batch = DashboardStatsBatch(get_active_graph())
+    for conf_data in batch.graphs:
+        kwargs = {'select_box_' + conf_data.graph_key: select_box_values.get(conf_data.graph_key, '')}
+        DashboardCharts(graph_key=conf_data.graph_key, batch=batch, require_chart_jscss=False, **kwargs)
+    return batch
+
+
+async def fetch_dashboard_charts(user, select_box_values=None):
+    """Returns the charts of the visible graphs with their ``data``.
+
+    ``select_box_values`` maps graph keys to their criteria values."""
+    batch = await sync_to_async(_get_batch)(select_box_values or {})
+    keys = await sync_to_async(batch.get_series_keys)(user)
+    cached_data = await aget_series_many(set(key for chart_keys in keys.values() for key in chart_keys))
+    plans = await sync_to_async(batch.plan)(user, keys, cached_data)
+
+    semaphore = asyncio.Semaphore(get_setting('ASYNC_CONCURRENCY'))
+    computed = {}
+
+    async def run_plan(plan):
+        async with semaphore:
+            await _in_thread(batch.run_plan)(plan, user, computed)
+
+    await asyncio.gather(*[run_plan(plan) for plan in plans])
+    if computed:
+        await sync_to_async(set_series_many)(computed)
+
+    def get_data():
+        for chart in batch.charts:
+            chart.data = chart.get_data(user)
+        return batch.charts
+    return await sync_to_async(get_data)()
+
+
+def _get_staff_user(request):
+    """Returns the user of the request if they are an active staff member, None
+    otherwise. The lazy ``request.user`` queries the session and the user:
+    it is evaluated here, out of the event loop."""
+    user = request.user
+    if user.is_active and user.is_staff:
+        return user
+    return None
+
+
+async def dashboard_data(request):
+    """Returns the rows of all the dashboard charts as JSON, by graph key and interval::
+
+        {"user_graph": {"days": {"names": ["Count"], "x": [1546300800000, ...], "y": [[3, ...]]}}}
+
+    Heatmaps hold their ``matrix``, 7 rows (Monday first) of 24 hours.
+
+    The criteria values are passed as ``select_box_<graph_key>`` parameters."""
+    user = await sync_to_async(_get_staff_user)(request)
+    if user is None:
+        return JsonResponse({'error': 'staff only'}, status=403)
+    select_box_values = dict(
+        (key[len('select_box_'):], value) for key, value in request.GET.items() if key.startswith('select_box_')
+    )
+    charts = await fetch_dashboard_charts(user, select_box_values)
+
+    def serialize():
+        data = {}
+        for chart in charts:
+            if isinstance(chart, DashboardHeatmap):
+                data.setdefault(chart.graph_key, {})[chart.interval] = {'matrix': chart.data}
+                continue
+            conf_data = chart.get_conf_data()
+            names = [name for name, aggregate in conf_data.get_metrics()] if conf_data else []
+            data.setdefault(chart.graph_key, {})[chart.interval] = {
+                'names': names,
+                'x': [int(time.mktime(row[0].timetuple()) * 1000) for row in chart.data],
+                'y': [[row[i] for row in chart.data] for i in range(1, len(chart.data[0]))] if chart.data else [],
+            }
+        return data
+    return JsonResponse(await sync_to_async(serialize)())
@@ -0,0 +1,229 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2014 Star2Billing S.L.
+#
+# The Initial Developer of the Original Code is
+# Arezqui Belaid <info@star2billing.com>
+#
+from collections import OrderedDict
+
+from django.core.exceptions import FieldError
+from django.utils.timezone import now
+
+from admin_tools_stats.cache import ALL_USERS, NO_DATA_USERS, get_user_scope, series_cache_key, \
+    get_data_versions, get_many, get_scope_series, get_series_many, set_series_many
+from admin_tools_stats.cost import ADMIT
+from admin_tools_stats.engine import time_series
+from admin_tools_stats.models import get_config_errors
+from admin_tools_stats.realtime import seed_counters
+from admin_tools_stats.semaphore import query_slot
+
+
+class DashboardStatsBatch(object):
+    """Fetches the series of all the charts of a dashboard at once.
+
+    The charts register themselves when created. When the first of them
+    needs its data, the batch reads the cached series of every chart in one
+    round trip, then plans the missing ones: charts aggregating the same
+    records (same model, filter, date field, interval and range) are
+    computed by a single query holding the aggregates of all of them, each
+    distinct aggregate computed only once.
+
+    The rendered charts are read at once the same way, before their series:
+    the series of a chart whose rendering is cached aren't fetched at all.
+    """
+
+    def __init__(self, graphs):
+        self.graphs = list(graphs.prefetch_related('criteria', 'metrics'))
+        self.conf_data = dict((conf_data.graph_key, conf_data) for conf_data in self.graphs)
+        self.charts = []
+        self.results = {}
+        self.stale_results = {}
+        self.data_versions = None
+        self.fragments = {}
+        self.fragments_read = False
+        self.config_errors = None
+
+    def add_chart(self, chart):
+        self.charts.append(chart)
+
+    def get_conf_data(self, graph_key):
+        return self.conf_data.get(graph_key)
+
+    def get_config_errors(self, graph_key):
+        """Returns the configuration errors of the graph, those of every
+        graph being read at once"""
+        if self.config_errors is None:
+            self.config_errors = get_config_errors(self.graphs, self.get_data_versions())
+        if graph_key not in self.config_errors:
+            return {'graph_key': "Graph '%s' doesn't exist" % graph_key}
+        return self.config_errors[graph_key]
+
+    def get_data_versions(self):
+        """Returns the data versions of the graphs, read once"""
+        if self.data_versions is None:
+            self.data_versions = get_data_versions(self.conf_data)
+        return self.data_versions
+
+    def get_fragment(self, chart, user):
+        """Returns the cached rendering of ``chart``, None if missing"""
+        if not self.fragments_read:
+            self.fragments_read = True
+            data_versions = self.get_data_versions()
+            keys = dict((chart.get_fragment_cache_key(user, data_versions), chart) for chart in self.charts)
+            keys.pop(None, None)
+            # the keys hold the data versions
+            for key, fragment in get_many(list(keys), dict.fromkeys(keys)).items():
+                self.fragments[keys[key]] = fragment
+        return self.fragments.get(chart)
+
+    def get_registrations(self, chart, user):
+        """Returns the rows of ``chart``, see ``DashboardChart.get_registrations``"""
+        if chart not in self.results:
+            self.prefetch(user)
+        if chart not in self.results:
+            # chart added after the batch was planned
+            self.results[chart] = chart.get_registrations(
+                user, chart.interval, chart.days, chart.graph_key, chart.select_box_value)
+        return self.results[chart]
+
+    def get_cache_key(self, chart, scope):
+        return series_cache_key(chart.graph_key, chart.interval, chart.days, chart.select_box_value, scope)
+
+    def prefetch(self, user):
+        """Fetches the rows of every chart not fetched yet"""
+        keys = self.get_series_keys(user)
+        stamps = self.get_stamps(keys)
+        plans = self.plan(user, keys, get_series_many(list(stamps), stamps))
+        computed = {}
+        for plan in plans:
+            self.run_plan(plan, user, computed)
+        set_series_many(computed, stamps)
+
+    def get_stamps(self, keys):
+        """Returns the data version of the graph of every series key, which
+        the rows are kept with in the process cache"""
+        data_versions = self.get_data_versions()
+        return dict(
+            (key, data_versions.get(chart.graph_key)) for chart, chart_keys in keys.items() for key in chart_keys
+        )
+
+    def get_series_keys(self, user):
+        """Returns the cache keys of the rows of every chart not fetched yet"""
+        charts = [chart for chart in self.charts
+                  if chart.batch_series and chart not in self.results and chart not in self.fragments and
+                  not self.get_config_errors(chart.graph_key)]
+        keys = OrderedDict()
+        for chart in charts:
+            scope = get_user_scope(self.get_conf_data(chart.graph_key), user)
+            keys[chart] = [self.get_cache_key(chart, scope)]
+            if scope != ALL_USERS:
+                keys[chart].append(self.get_cache_key(chart, NO_DATA_USERS))
+        return keys
+
+    def plan(self, user, keys, cached_data):
+        """Takes the rows of the charts of ``keys`` from ``cached_data``, and
+        returns the plans computing the missing ones, each plan runnable on its own"""
+        plans = OrderedDict()
+        today = now()
+        for chart, chart_keys in keys.items():
+            scope = get_user_scope(self.get_conf_data(chart.graph_key), user)
+            cached = get_scope_series(cached_data, chart_keys, scope)
+            if cached is not None and cached[1]:
+                self.results[chart] = cached[0]
+                continue
+            if cached is not None:
+                self.stale_results[chart] = cached[0]
+            self.plan_chart(plans, chart, user, today)
+        return list(plans.values())
+
+    def plan_chart(self, plans, chart, user, today):
+        """Adds the query computing ``chart`` rows to ``plans``.
+
+        Charts which can't share a query (broken configuration, series
+        precomputed per user or broken down by a field, too expensive
+        graphs) get a plan of their own.
+        """
+        conf_data = self.get_conf_data(chart.graph_key)
+        scope = get_user_scope(conf_data, user)
+        if conf_data is None or (scope != ALL_USERS and conf_data.precompute_user_series) or \
+                conf_data.group_by_field_name or chart.get_admission(conf_data) != ADMIT:
+            self.plan_single_chart(plans, chart)
+            return
+
+        user_filter = user if scope != ALL_USERS else None
+        try:
+            filter_kwargs = chart.get_filter_kwargs(conf_data, chart.select_box_value, user_filter)
+            queryset = chart.get_queryset(conf_data, chart.select_box_value, user_filter)
+        except (LookupError, FieldError, TypeError):
+            self.plan_single_chart(plans, chart)
+            return
+
+        begin, end = chart.get_query_range(conf_data, chart.days, today)
+        signature = (
+            conf_data.model_app_name.lower(), conf_data.model_name.lower(),
+            tuple(sorted((key, repr(value)) for key, value in filter_kwargs.items())),
+            conf_data.date_field_name, chart.interval, begin, end, tuple(conf_data.get_databases()),
+        )
+        plan = plans.setdefault(signature, {
+            'queryset': queryset,
+            'databases': conf_data.get_databases(),
+            'date_field': conf_data.date_field_name,
+            'begin': begin,
+            'end': end,
+            'interval': chart.interval,
+            'aggregates': OrderedDict(),
+            'charts': [],
+        })
+        columns = []
+        for name, aggregate in conf_data.get_metrics():
+            aggregate_signature = repr(aggregate)
+            if aggregate_signature not in plan['aggregates']:
+                plan['aggregates'][aggregate_signature] = aggregate
+            columns.append(list(plan['aggregates']).index(aggregate_signature))
+        plan['charts'].append((chart, scope, columns))
+
+    def plan_single_chart(self, plans, chart):
+        plans[('chart', id(chart))] = {'queryset': None, 'charts': [(chart, None, None)]}
+
+    def run_plan(self, plan, user, computed):
+        """Runs the query of ``plan`` and splits its rows between the charts.
+
+        When the database is busy, the charts get their stale rows if all of
+        them have some, otherwise the query waits for a slot."""
+        if plan['queryset'] is None:
+            chart = plan['charts'][0][0]
+            self.results[chart] = chart.get_registrations(
+                user, chart.interval, chart.days, chart.graph_key, chart.select_box_value)
+            return
+        stale = all(chart in self.stale_results for chart, scope, columns in plan['charts'])
+        rows = None
+        with query_slot(wait=not stale) as acquired:
+            if acquired:
+                try:
+                    rows = time_series(plan['queryset'], plan['date_field'], list(plan['aggregates'].values()),
+                                       plan['begin'], plan['end'], plan['interval'], databases=plan['databases'])
+                except (LookupError, FieldError, TypeError):
+                    pass
+
+        if not acquired:
+            for chart, scope, columns in plan['charts']:
+                self.results[chart] = chart.get_stale_registrations(
+                    self.stale_results.get(chart), self.get_conf_data(chart.graph_key), chart.interval, chart.days)
+            return
+        if rows is None:
+            # let every chart report its own error
+            for chart, scope, columns in plan['charts']:
+                self.results[chart] = chart.get_registrations(
+                    user, chart.interval, chart.days, chart.graph_key, chart.select_box_value)
+            return
+
+        for chart, scope, columns in plan['charts']:
+            chart_rows = [(row[0],) + tuple(row[column + 1] for column in columns) for row in rows]
+            self.results[chart] = chart_rows
+            computed[self.get_cache_key(chart, scope)] = chart_rows
+            if scope == ALL_USERS:
+                seed_counters(self.get_conf_data(chart.graph_key), chart.interval, chart.select_box_value, chart_rows)
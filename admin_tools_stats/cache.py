@@ -0,0 +1,269 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2014 Star2Billing S.L.
+#
+# The Initial Developer of the Original Code is
+# Arezqui Belaid <info@star2billing.com>
+#
+import threading
+import time
+from collections import OrderedDict
+from hashlib import md5
+from uuid import uuid4
+
+from django.core.cache import cache
+from django.utils.encoding import force_bytes
+
+from admin_tools_stats.app_settings import get_setting
+from admin_tools_stats.instrumentation import instrumentation
+from admin_tools_stats.packing import pack_rows, unpack_rows
+
+# scope of the series shared by every user who sees all the data
+ALL_USERS = 'all'
+# scope of the series of users without any data, set when fanning out
+# per-user series with the users recorded without data (see ``get_scope_series``)
+NO_DATA_USERS = 'nodata'
+# graphs with real-time counters, by model
+REALTIME_GRAPHS_KEY = 'admin_tools_stats:realtime_graphs'
+
+
+class LocalCache(object):
+    """Size-bounded LRU cache of the process, in front of the shared cache.
+
+    Entries are kept ``LOCAL_CACHE_TIMEOUT`` seconds at most, and stamped
+    with the data version of their graph when stored: they are read back
+    only with the same stamp, so changing the data version of a graph in any
+    process expires them in every process.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, stamps):
+        """Returns the values of the keys of ``stamps`` stored with their stamp"""
+        values = {}
+        current_time = time.time()
+        with self.lock:
+            for key, stamp in stamps.items():
+                entry = self.entries.pop(key, None)
+                if entry is not None and entry[0] >= current_time and entry[1] == stamp:
+                    # most recently used last
+                    self.entries[key] = entry
+                    values[key] = entry[2]
+            self.hits += len(values)
+            self.misses += len(stamps) - len(values)
+        return values
+
+    def set_many(self, data, stamps):
+        """Stores the values of ``data`` with their stamp in ``stamps``,
+        dropping the least recently used entries above ``LOCAL_CACHE_SIZE``"""
+        size = get_setting('LOCAL_CACHE_SIZE')
+        if not size:
+            return
+        expires_at = time.time() + get_setting('LOCAL_CACHE_TIMEOUT')
+        with self.lock:
+            for key, value in data.items():
+                self.entries.pop(key, None)
+                self.entries[key] = (expires_at, stamps.get(key), value)
+            while len(self.entries) > size:
+                self.entries.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+local_cache = LocalCache()
+
+
+def get_many(keys, stamps=None):
+    """Returns the cached values of ``keys``.
+
+    The keys of ``stamps`` are read from the process cache first (see
+    ``LocalCache``), the other ones from the shared cache in one round trip,
+    and kept in the process cache if they have a stamp. Values are shared
+    with the process cache: they must not be modified.
+    """
+    stamps = stamps or {}
+    values = local_cache.get_many(dict((key, stamps[key]) for key in keys if key in stamps))
+    missing = [key for key in keys if key not in values]
+    if missing:
+        shared_values = cache.get_many(missing)
+        instrumentation.add('shared_cache_reads', len(missing))
+        instrumentation.add('shared_cache_hits', len(shared_values))
+        local_cache.set_many(dict((key, value) for key, value in shared_values.items() if key in stamps), stamps)
+        values.update(shared_values)
+    return values
+
+
+def set_many(data, timeout, stamps=None):
+    """Caches the values of ``data`` in the shared cache, and in the process
+    cache if they have a stamp in ``stamps``"""
+    stamps = stamps or {}
+    cache.set_many(data, timeout)
+    local_cache.delete_many(data)
+    local_cache.set_many(dict((key, value) for key, value in data.items() if key in stamps), stamps)
+
+
+def get_user_scope(conf_data, user):
+    """Returns whose data the user sees on the graph: ``ALL_USERS`` or his pk.
+
+    ``user`` None stands for an user seeing all the data."""
+    if conf_data is not None and conf_data.user_field_name and user is not None and not user.is_superuser:
+        return user.pk
+    return ALL_USERS
+
+
+def criteria_hash(select_box_value):
+    """Returns the criteria value as held in the cache keys"""
+    return md5(force_bytes(select_box_value or '')).hexdigest()
+
+
+def series_cache_key(graph_key, interval, days, select_box_value, scope):
+    """Returns the cache key of a graph serie"""
+    return 'admin_tools_stats:series:%s:%s:%s:%s:%s' % (
+        graph_key, interval, days, criteria_hash(select_box_value), scope,
+    )
+
+
+def set_series_many(data, stamps=None, no_data_users=None):
+    """Caches the rows of the series by key, with the time they were computed.
+
+    Rows are fresh for ``CACHE_TIMEOUT`` seconds, and kept stale for
+    ``STALE_CACHE_TIMEOUT`` seconds, packed (see ``pack_rows``). See
+    ``set_many`` for ``stamps``.
+
+    ``no_data_users`` maps the keys of ``NO_DATA_USERS`` rows to the pks of
+    the users without data, who are served them."""
+    computed_at = time.time()
+    no_data_users = no_data_users or {}
+    set_many(dict(
+        (key, (computed_at, pack_rows(rows)) + ((frozenset(no_data_users[key]),) if key in no_data_users else ()))
+        for key, rows in data.items()
+    ), max(get_setting('CACHE_TIMEOUT'), get_setting('STALE_CACHE_TIMEOUT')), stamps)
+
+
+def get_series_many(keys, stamps=None):
+    """Returns the cached ``(rows, fresh)`` of the series by key. See
+    ``get_many`` for ``stamps``."""
+    return decode_series_many(get_many(keys, stamps))
+
+
+def decode_series_many(cached_data):
+    """Returns the ``(rows, fresh)`` of the series read from the cache,
+    followed by the users without data for ``NO_DATA_USERS`` rows"""
+    fresh_after = time.time() - get_setting('CACHE_TIMEOUT')
+    return dict(
+        (key, (unpack_rows(entry[1]), entry[0] > fresh_after) + tuple(entry[2:]))
+        for key, entry in cached_data.items()
+    )
+
+
+def get_scope_series(cached_data, keys, scope):
+    """Returns the ``(rows, fresh)`` of the first of ``keys`` in the decoded
+    ``cached_data`` served to ``scope``, None if there is none.
+
+    The rows of ``NO_DATA_USERS`` are served only to the users recorded
+    without data when they were precomputed: the rows of the others are
+    computed, whether their own rows were evicted or they didn't exist."""
+    for key in keys:
+        cached = cached_data.get(key)
+        if cached is not None and (len(cached) < 3 or scope in cached[2]):
+            return cached[:2]
+    return None
+
+
+def breakdown_cache_key(graph_key, interval, days, select_box_value, scope):
+    """Returns the cache key of the top values of a serie broken down by a field"""
+    return series_cache_key(graph_key, interval, days, select_box_value, scope).replace(':series:', ':breakdown:')
+
+
+def baseline_cache_key(graph_key, interval, days, select_box_value, scope):
+    """Returns the cache key of the values a cumulative serie starts from"""
+    return series_cache_key(graph_key, interval, days, select_box_value, scope).replace(':series:', ':baseline:')
+
+
+def set_breakdown_groups(key, groups):
+    """Caches the top values of a broken down serie, as long as its rows"""
+    cache.set(key, groups, max(get_setting('CACHE_TIMEOUT'), get_setting('STALE_CACHE_TIMEOUT')))
+
+
+def fragment_cache_key(graph_key, interval, days, criteria, scope, language, data_version):
+    """Returns the cache key of a rendered chart"""
+    return 'admin_tools_stats:fragment:%s:%s:%s:%s:%s:%s:%s' % (
+        graph_key, interval, days, md5(force_bytes(repr(criteria))).hexdigest(), scope, language, data_version,
+    )
+
+
+def dashboard_stats_cache_key(graph_key):
+    """Returns the cache key of the configuration of a graph"""
+    return 'admin_tools_stats:dashboard_stats:%s' % graph_key
+
+
+def cost_cache_key(graph_key):
+    """Returns the cache key of the cost estimate of a graph"""
+    return 'admin_tools_stats:cost:%s' % graph_key
+
+
+def criteria_values_cache_key(graph_key):
+    """Returns the cache key of the discovered dynamic criteria values of a graph"""
+    return 'admin_tools_stats:criteria_values:%s' % graph_key
+
+
+def realtime_graph_key(graph_key):
+    """Returns the cache key of the time the graph was registered for the
+    realtime counters at"""
+    return 'admin_tools_stats:realtime:%s' % graph_key
+
+
+def config_errors_cache_key(graph_key):
+    """Returns the cache key of the configuration errors of a graph"""
+    return 'admin_tools_stats:config_errors:%s' % graph_key
+
+
+def data_version_key(graph_key):
+    return 'admin_tools_stats:version:%s' % graph_key
+
+
+def get_data_versions(graph_keys):
+    """Returns the data version of every graph.
+
+    The rendered charts are cached for their data version, changed whenever
+    the graph configuration or its precomputed series change."""
+    keys = dict((data_version_key(graph_key), graph_key) for graph_key in graph_keys)
+    versions = cache.get_many(keys)
+    data_versions = {}
+    for key, graph_key in keys.items():
+        if key not in versions:
+            version = uuid4().hex
+            if not cache.add(key, version, None):
+                version = cache.get(key, version)
+            versions[key] = version
+        data_versions[graph_key] = versions[key]
+    return data_versions
+
+
+def bump_data_version(graph_key):
+    """Changes the data version of the graph, expiring its rendered charts"""
+    cache.set(data_version_key(graph_key), uuid4().hex, None)
+
+
+def expire_graph(graph_key):
+    """Expires what is cached from the graph configuration"""
+    bump_data_version(graph_key)
+    cache.delete_many([REALTIME_GRAPHS_KEY, realtime_graph_key(graph_key), dashboard_stats_cache_key(graph_key),
+                       cost_cache_key(graph_key), criteria_values_cache_key(graph_key),
+                       config_errors_cache_key(graph_key)])
@@ -0,0 +1,89 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2014 Star2Billing S.L.
+#
+# The Initial Developer of the Original Code is
+# Arezqui Belaid <info@star2billing.com>
+#
+"""Admission control of the graphs from the database cost estimates.
+
+Before the series of a graph are computed on a dashboard load, the cost the
+database estimates (``EXPLAIN``) for the records of the graph is compared
+with ``ADMIN_TOOLS_STATS_MAX_COST`` and ``ADMIN_TOOLS_STATS_BACKGROUND_COST``:
+graphs above the first are refused, graphs above the second (or with
+``compute_in_background``) are computed in background only, by the
+``run_dashboard_stats_worker`` and ``precompute_dashboard_stats`` commands.
+Estimates are cached per graph.
+"""
+import json
+
+from django.core.cache import cache
+from django.db import DatabaseError, connections, transaction
+from six import string_types
+
+from admin_tools_stats.app_settings import get_setting
+from admin_tools_stats.cache import cost_cache_key
+
+ADMIT = 'admit'
+BACKGROUND = 'background'
+REFUSE = 'refuse'
+
+
+def _load_plan(plan):
+    return json.loads(plan) if isinstance(plan, string_types + (bytes,)) else plan
+
+
+def explain_cost(queryset):
+    """Returns the cost the database estimates for ``queryset``, None if it
+    doesn't give any (ex. SQLite)"""
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        prefix = 'EXPLAIN (FORMAT JSON) '
+    elif connection.vendor == 'mysql':
+        prefix = 'EXPLAIN FORMAT=JSON '
+    else:
+        return None
+    sql, params = queryset.query.sql_with_params()
+    try:
+        with transaction.atomic(using=queryset.db):
+            with connection.cursor() as cursor:
+                cursor.execute(prefix + sql, params)
+                plan = _load_plan(cursor.fetchone()[0])
+    except DatabaseError:
+        return None
+    if connection.vendor == 'postgresql':
+        return float(plan[0]['Plan']['Total Cost'])
+    return float(plan['query_block']['cost_info']['query_cost'])
+
+
+def get_cost(conf_data, get_queryset):
+    """Returns the cached cost estimate of the graph, ``get_queryset``
+    returning the records to estimate"""
+    key = cost_cache_key(conf_data.graph_key)
+    cost = cache.get(key)
+    if cost is None:
+        cost = (explain_cost(get_queryset()),)
+        cache.set(key, cost, get_setting('COST_CACHE_TIMEOUT'))
+    return cost[0]
+
+
+def get_admission(conf_data, get_queryset):
+    """Returns how the series of the graph can be computed: ``ADMIT`` on
+    demand, in ``BACKGROUND`` only or ``REFUSE``"""
+    if conf_data.compute_in_background:
+        return BACKGROUND
+    max_cost = get_setting('MAX_COST')
+    background_cost = get_setting('BACKGROUND_COST')
+    if max_cost is None and background_cost is None:
+        return ADMIT
+    cost = get_cost(conf_data, get_queryset)
+    if cost is None:
+        return ADMIT
+    if max_cost is not None and cost > max_cost:
+        return REFUSE
+    if background_cost is not None and cost > background_cost:
+        return BACKGROUND
+    return ADMIT
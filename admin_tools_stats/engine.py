@@ -0,0 +1,595 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2014 Star2Billing S.L.
+#
+# The Initial Developer of the Original Code is
+# Arezqui Belaid <info@star2billing.com>
+#
+import math
+from collections import OrderedDict
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # Python 2 without futures
+    ThreadPoolExecutor = None
+
+from django.db import connections, transaction
+from django.db.models import Case, ExpressionWrapper, F, FloatField, IntegerField, Value, When
+from django.db.models.aggregates import Aggregate, Count, Sum, Avg, Max, Min, StdDev, Variance
+from django.db.models.functions import ExtractHour, ExtractWeekDay, Trunc
+try:
+    from django.db.models.functions import Ceil, Ln
+except ImportError:  # Django < 2.2
+    from django.db.models import Func
+
+    class Ceil(Func):
+        function = 'CEIL'
+
+    class Ln(Func):
+        function = 'LN'
+from dateutil.relativedelta import relativedelta
+from dateutil.parser import parse
+from qsstats.utils import get_bounds, _remove_time
+from six import string_types
+
+from django.utils.encoding import force_text
+from django.utils.timezone import now
+from admin_tools_stats.app_settings import get_setting
+from admin_tools_stats.instrumentation import instrumentation
+from admin_tools_stats.sketch import LogHistogram
+
+
+class PercentileCont(Aggregate):
+    """Continuous percentile, native on PostgreSQL and Oracle"""
+    function = 'PERCENTILE_CONT'
+    name = 'PercentileCont'
+    template = '%(function)s(%(percentile)s) WITHIN GROUP (ORDER BY %(expressions)s)'
+
+    def __init__(self, expression, percentile, **extra):
+        self.field_name = expression
+        self.percentile = percentile
+        super(PercentileCont, self).__init__(
+            expression, percentile=percentile, output_field=FloatField(), **extra)
+
+
+PERCENTILES = {
+    'P50': 0.5,
+    'P95': 0.95,
+    'P99': 0.99,
+}
+
+
+def get_aggregate(operation, field_name):
+    """Returns the Django aggregate computing ``operation`` over ``field_name``"""
+    if operation in PERCENTILES:
+        return PercentileCont(field_name, PERCENTILES[operation])
+    operations = {
+        'DistinctCount': lambda: Count(field_name, distinct=True),
+        'Count': lambda: Count(field_name),
+        'Sum': lambda: Sum(field_name),
+        'Avg': lambda: Avg(field_name),
+        'StdDev': lambda: StdDev(field_name),
+        'Max': lambda: Max(field_name),
+        'Min': lambda: Min(field_name),
+        'Variance': lambda: Variance(field_name),
+    }
+    return operations[operation]()
+
+
+def default_aggregate():
+    """Aggregate used when a graph doesn't configure any operation"""
+    return Count('pk', distinct=True)
+
+
+def has_native_percentile(qs):
+    """Returns True if the database of ``qs`` implements ``PERCENTILE_CONT``"""
+    return connections[qs.db].vendor in ('postgresql', 'oracle')
+
+
+def get_buckets(start, end, interval):
+    """Returns the list of bucket start dates covering ``start`` - ``end``"""
+    interval_s = interval.rstrip('s')
+    start, _ = get_bounds(start, interval_s)
+    _, end = get_bounds(end, interval_s)
+    buckets = []
+    dt = start
+    while dt < end:
+        buckets.append(dt)
+        dt = dt + relativedelta(**{interval: 1})
+    return buckets
+
+
+def _to_datetime(value):
+    if isinstance(value, string_types):
+        return parse(value, yearfirst=True, default=_remove_time(now()))
+    return value
+
+
+def bucketed_values(qs, date_field, buckets, interval, group_by, annotations):
+    """Groups ``qs`` by bucket (and ``group_by`` fields) and computes ``annotations``.
+
+    Returns a list of dicts holding the bucket date as ``d``, the
+    ``group_by`` values and the annotations.
+    """
+    if not buckets:
+        return []
+    # taken inside transactions only
+    sid = transaction.savepoint(using=qs.db)
+    try:
+        values = _fast_bucketed_values(qs, date_field, buckets, interval, group_by, annotations)
+    except ValueError:
+        # the database doesn't support timezones, query bucket by bucket
+        transaction.savepoint_rollback(sid, using=qs.db)
+        return _slow_bucketed_values(qs, date_field, buckets, interval, group_by, annotations)
+    transaction.savepoint_commit(sid, using=qs.db)
+    return values
+
+
+def _fast_bucketed_values(qs, date_field, buckets, interval, group_by, annotations):
+    """Computes every bucket with a single ``annotate`` query"""
+    interval_s = interval.rstrip('s')
+    start = buckets[0]
+    end = buckets[-1] + relativedelta(**{interval: 1}) - relativedelta(microseconds=1)
+    kwargs = {'%s__range' % date_field: (start, end)}
+    aggregate_data = qs.filter(**kwargs).\
+        annotate(d=Trunc(date_field, interval_s, tzinfo=start.tzinfo)).\
+        order_by().values('d', *group_by).\
+        annotate(**annotations)
+
+    items = []
+    for item in aggregate_data:
+        item['d'] = _to_datetime(item['d'])
+        items.append(item)
+    return items
+
+
+def _slow_bucketed_values(qs, date_field, buckets, interval, group_by, annotations):
+    """Computes the buckets with one query per bucket"""
+    items = []
+    for dt in buckets:
+        end = dt + relativedelta(**{interval: 1}) - relativedelta(microseconds=1)
+        bucket_qs = qs.filter(**{'%s__range' % date_field: (dt, end)})
+        if group_by:
+            bucket_items = bucket_qs.order_by().values(*group_by).annotate(**annotations)
+        else:
+            bucket_items = [bucket_qs.aggregate(**annotations)]
+        for item in bucket_items:
+            item['d'] = dt
+            items.append(item)
+    return items
+
+
+def time_series(qs, date_field, aggregates, start, end, interval='days', databases=None):
+    """Aggregate ``qs`` over ``interval`` buckets between ``start`` and ``end``.
+
+    All ``aggregates`` (a list of Django aggregates) are computed together
+    in one grouped query. Percentiles are computed natively where the
+    database supports it, and otherwise estimated from one histogram query
+    per aggregated field. Returns a list of ``(date, value1, value2, ...)``
+    rows, one row per bucket, in the order of ``aggregates``.
+
+    Records split across several ``databases`` (aliases) are aggregated by
+    each of them and merged, see ``sharded_time_series``.
+    """
+    series = grouped_time_series(qs, date_field, aggregates, start, end, interval, databases=databases)
+    return series.get(None) or empty_time_series(aggregates, start, end, interval)
+
+
+def empty_time_series(aggregates, start, end, interval='days'):
+    """Returns the rows of a serie without any data"""
+    zeros = tuple(0 for aggregate in aggregates)
+    return [(dt,) + zeros for dt in get_buckets(start, end, interval)]
+
+
+@instrumentation.timed
+def grouped_time_series(qs, date_field, aggregates, start, end, interval='days', group_by=None, databases=None):
+    """Like ``time_series``, but computes one serie per value of ``group_by`` field.
+
+    Every serie is still computed by the same grouped query. Returns a dict
+    mapping the values of ``group_by`` (None if not grouped) to their rows;
+    values without any data in the range are missing.
+    """
+    if databases:
+        return sharded_time_series(qs, date_field, aggregates, start, end, interval, group_by, databases)
+    buckets = get_buckets(start, end, interval)
+    group_fields = [group_by] if group_by else []
+    native_percentile = has_native_percentile(qs)
+    annotations = {}
+    sketched = {}
+    for i, aggregate in enumerate(aggregates):
+        if isinstance(aggregate, PercentileCont) and not native_percentile:
+            sketched['agg%d' % i] = aggregate
+        else:
+            annotations['agg%d' % i] = aggregate
+
+    data = {}
+    if annotations:
+        for item in bucketed_values(qs, date_field, buckets, interval, group_fields, annotations):
+            data.setdefault(item.get(group_by), {})[item['d']] = item
+    for field_name in set(aggregate.field_name for aggregate in sketched.values()):
+        histograms = histogram_series(qs, date_field, field_name, buckets, interval, group_by)
+        for (group, dt), histogram in histograms.items():
+            item = data.setdefault(group, {}).setdefault(dt, {})
+            for name, aggregate in sketched.items():
+                if aggregate.field_name == field_name:
+                    item[name] = histogram.quantile(aggregate.percentile)
+
+    names = ['agg%d' % i for i in range(len(aggregates))]
+    return dict(
+        (group, [(dt,) + tuple(group_data.get(dt, {}).get(name, 0) for name in names) for dt in buckets])
+        for group, group_data in data.items()
+    )
+
+
+def histogram_series(qs, date_field, field_name, buckets, interval, group_by=None):
+    """Returns a ``LogHistogram`` of ``field_name`` values for each bucket.
+
+    The histograms are keyed by ``(group, bucket)``, where group is the value
+    of ``group_by`` field (None if not grouped). The bins are computed by the
+    database, so only the ``(bucket, bin, count)`` rows are transferred.
+    """
+    relative_accuracy = get_setting('PERCENTILE_ACCURACY')
+    histograms = {}
+    group_fields = [group_by] if group_by else []
+    items = bucketed_values(sketched(qs, field_name), date_field, buckets, interval,
+                            group_fields + ['sketch_sign', 'sketch_key'], {'sketch_count': Count('pk')})
+    for item in items:
+        key = (item.get(group_by), item['d'])
+        histogram = histograms.setdefault(key, LogHistogram(relative_accuracy))
+        histogram.add(item['sketch_sign'], int(item['sketch_key']), item['sketch_count'])
+    return histograms
+
+
+def sketched(qs, field_name):
+    """Annotates the records of ``qs`` with the ``(sketch_sign, sketch_key)``
+    bin of their ``field_name`` value in a ``LogHistogram``"""
+    relative_accuracy = get_setting('PERCENTILE_ACCURACY')
+    log_gamma = math.log((1 + relative_accuracy) / (1 - relative_accuracy))
+    positive = {'%s__gt' % field_name: 0}
+    negative = {'%s__lt' % field_name: 0}
+    return qs.filter(**{'%s__isnull' % field_name: False}).annotate(
+        sketch_sign=Case(
+            When(then=Value(1), **positive),
+            When(then=Value(-1), **negative),
+            default=Value(0), output_field=IntegerField(),
+        ),
+        sketch_key=Case(
+            When(then=Ceil(Ln(F(field_name)) / log_gamma), **positive),
+            When(then=Ceil(Ln(F(field_name) * -1) / log_gamma), **negative),
+            default=Value(0), output_field=IntegerField(),
+        ),
+    )
+
+
+def _add(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return a + b
+
+
+def _extreme(function):
+    def combine(a, b):
+        values = [value for value in (a, b) if value is not None]
+        return function(values) if values else None
+    return combine
+
+
+def get_partial_merger(aggregate, add_partial):
+    """Splits ``aggregate`` into partial aggregates computed by each database.
+
+    ``add_partial(partial_aggregate, combine)`` registers a partial aggregate,
+    merged between databases by ``combine(a, b)``, and returns its name.
+    Returns the function computing the value of ``aggregate`` from the
+    merged partial values and the merged histograms of the fields.
+    Raises TypeError if ``aggregate`` can't be merged (distinct counts).
+    """
+    if isinstance(aggregate, PercentileCont):
+        def merge_percentile(values, histograms):
+            histogram = histograms.get(aggregate.field_name)
+            return histogram.quantile(aggregate.percentile) if histogram else 0
+        return merge_percentile
+
+    expression = aggregate.get_source_expressions()[0]
+    if isinstance(aggregate, Count):
+        if getattr(aggregate, 'distinct', False) and getattr(expression, 'name', None) != 'pk':
+            # records of different databases may share their values
+            raise TypeError("DistinctCount can't be merged across databases")
+        name = add_partial(Count(expression), _add)
+        return lambda values, histograms: values.get(name) or 0
+    if isinstance(aggregate, Sum):
+        name = add_partial(Sum(expression), _add)
+        return lambda values, histograms: values.get(name) or 0
+    if isinstance(aggregate, (Max, Min)):
+        name = add_partial(aggregate.__class__(expression), _extreme(max if isinstance(aggregate, Max) else min))
+        return lambda values, histograms: values.get(name)
+
+    total = add_partial(Sum(expression, output_field=FloatField()), _add)
+    count = add_partial(Count(expression), _add)
+    if isinstance(aggregate, Avg):
+        def merge_avg(values, histograms):
+            return float(values[total]) / values[count] if values.get(count) else None
+        return merge_avg
+
+    if isinstance(aggregate, (Variance, StdDev)):
+        squares = add_partial(
+            Sum(ExpressionWrapper(expression * expression, output_field=FloatField())), _add)
+        sample = aggregate.function.endswith('SAMP')
+
+        def merge_variance(values, histograms):
+            n = values.get(count) or 0
+            if n - sample <= 0:
+                return None
+            variance = max((float(values[squares]) - float(values[total]) ** 2 / n) / (n - sample), 0)
+            return math.sqrt(variance) if isinstance(aggregate, StdDev) else variance
+        return merge_variance
+
+    raise TypeError("%s can't be merged across databases" % aggregate.name)
+
+
+def run_on_databases(function, databases):
+    """Returns ``function(alias)`` of every database alias, run concurrently"""
+    if len(databases) == 1 or ThreadPoolExecutor is None:
+        return [function(alias) for alias in databases]
+
+    def run(alias):
+        try:
+            return function(alias)
+        finally:
+            # connections of the executor threads are never reused
+            connections.close_all()
+
+    executor = ThreadPoolExecutor(max_workers=len(databases))
+    try:
+        return list(executor.map(run, databases))
+    finally:
+        executor.shutdown()
+
+
+def sharded_time_series(qs, date_field, aggregates, start, end, interval, group_by, databases):
+    """``grouped_time_series`` of records split across several ``databases``.
+
+    Each database computes, concurrently, the partial aggregates of its
+    records (counts, sums, extremes, sums of squares and percentile
+    histograms) with one grouped query, merged per bucket into the values
+    of ``aggregates``. Distinct counts of other fields than the primary key
+    can't be merged and raise TypeError.
+    """
+    buckets = get_buckets(start, end, interval)
+    group_fields = [group_by] if group_by else []
+    partials = OrderedDict()
+
+    def add_partial(aggregate, combine):
+        for name, (partial, partial_combine) in partials.items():
+            if repr(partial) == repr(aggregate):
+                return name
+        name = 'part%d' % len(partials)
+        partials[name] = (aggregate, combine)
+        return name
+
+    mergers = [get_partial_merger(aggregate, add_partial) for aggregate in aggregates]
+    histogram_fields = set(aggregate.field_name for aggregate in aggregates if isinstance(aggregate, PercentileCont))
+
+    def query(alias):
+        shard_qs = qs.using(alias)
+        items = []
+        if partials:
+            annotations = dict((name, aggregate) for name, (aggregate, combine) in partials.items())
+            items = bucketed_values(shard_qs, date_field, buckets, interval, group_fields, annotations)
+        histograms = dict(
+            (field_name, histogram_series(shard_qs, date_field, field_name, buckets, interval, group_by))
+            for field_name in histogram_fields
+        )
+        return items, histograms
+
+    values = {}
+    histograms = {}
+    for items, shard_histograms in run_on_databases(query, databases):
+        for item in items:
+            merged = values.setdefault((item.get(group_by), item['d']), {})
+            for name, (aggregate, combine) in partials.items():
+                merged[name] = combine(merged.get(name), item[name])
+        for field_name, field_histograms in shard_histograms.items():
+            for key, histogram in field_histograms.items():
+                merged = histograms.setdefault(key, {})
+                if field_name in merged:
+                    merged[field_name].merge(histogram)
+                else:
+                    merged[field_name] = histogram
+
+    data = {}
+    for key in set(values) | set(histograms):
+        group, dt = key
+        data.setdefault(group, {})[dt] = tuple(
+            merge(values.get(key, {}), histograms.get(key, {})) for merge in mergers)
+    empty = tuple(0 for aggregate in aggregates)
+    return dict(
+        (group, [(dt,) + group_data.get(dt, empty) for dt in buckets])
+        for group, group_data in data.items()
+    )
+
+
+def top_values(qs, field_name, limit, databases=None):
+    """Returns the ``limit`` most frequent values of ``field_name`` in ``qs``,
+    the most frequent first, None excluded"""
+    qs = qs.exclude(**{field_name + '__isnull': True}).order_by()
+    querysets = [qs.using(alias) for alias in databases] if databases else [qs]
+    counts = {}
+    for queryset in querysets:
+        top = queryset.values_list(field_name).annotate(count=Count('pk')).order_by('-count')[:limit]
+        for value, count in top:
+            counts[value] = counts.get(value, 0) + count
+    return sorted(counts, key=lambda value: (-counts[value], force_text(value)))[:limit]
+
+
+def discover_values(qs, field_name, limit, databases=None):
+    """Returns the values of ``field_name`` in ``qs``, sorted, at most ``limit``.
+
+    The distinct values are read with a query bounded to ``limit + 1`` rows;
+    when there are more of them, the ``limit`` most frequent values are
+    returned instead.
+    """
+    distinct_qs = qs.exclude(**{field_name + '__isnull': True}).order_by()
+    querysets = [distinct_qs.using(alias) for alias in databases] if databases else [distinct_qs]
+    values = set()
+    for queryset in querysets:
+        values.update(queryset.values_list(field_name, flat=True).distinct()[:limit + 1])
+    if len(values) > limit:
+        values = top_values(qs, field_name, limit, databases)
+    return sorted(values, key=force_text)
+
+
+def breakdown_time_series(qs, date_field, aggregate, start, end, interval, group_by, limit, databases=None):
+    """Breaks ``aggregate`` of ``qs`` down by the ``limit`` most frequent values
+    of ``group_by`` field in the range.
+
+    The values are ranked by a first query counting the records of each,
+    then all the series are computed by one grouped query, the records of
+    the other values (or without any) aggregated together. Returns the top
+    values and the ``(date, value of each top value..., value of the others)``
+    rows.
+    """
+    buckets = get_buckets(start, end, interval)
+    if not buckets:
+        return [], []
+    range_end = buckets[-1] + relativedelta(**{interval: 1}) - relativedelta(microseconds=1)
+    groups = top_values(qs.filter(**{'%s__range' % date_field: (buckets[0], range_end)}),
+                        group_by, limit, databases)
+    if groups:
+        qs = qs.annotate(breakdown_group=Case(
+            When(then=F(group_by), **{'%s__in' % group_by: groups}),
+            default=Value(None),
+        ))
+        series = grouped_time_series(qs, date_field, [aggregate], start, end, interval,
+                                     group_by='breakdown_group', databases=databases)
+    else:
+        series = grouped_time_series(qs, date_field, [aggregate], start, end, interval, databases=databases)
+    empty = empty_time_series([aggregate], start, end, interval)
+    columns = [series.get(group, empty) for group in groups] + [series.get(None, empty)]
+    rows = [(row[0],) + tuple(column[i][1] for column in columns) for i, row in enumerate(empty)]
+    return groups, rows
+
+
+def empty_heatmap():
+    """Returns the matrix of a heatmap without any data"""
+    return [[0] * 24 for day in range(7)]
+
+
+@instrumentation.timed
+def heatmap(qs, date_field, aggregate, start, end, databases=None):
+    """Returns ``aggregate`` of ``qs`` records between ``start`` and ``end`` by
+    day of the week and hour of the day.
+
+    The 7 x 24 matrix (Monday first, in the current timezone) is computed by
+    one query grouped by ``ExtractWeekDay`` and ``ExtractHour`` (one per
+    database, merged like ``sharded_time_series``). Percentiles are estimated
+    from the histograms of the cells where they aren't native, like the
+    time series.
+    """
+    # extracted in the current timezone
+    qs = qs.filter(**{'%s__range' % date_field: (start, end)}).annotate(
+        heatmap_day=ExtractWeekDay(date_field),
+        heatmap_hour=ExtractHour(date_field),
+    )
+
+    if isinstance(aggregate, PercentileCont) and (databases or not has_native_percentile(qs)):
+        qs = sketched(qs, aggregate.field_name).order_by().values(
+            'heatmap_day', 'heatmap_hour', 'sketch_sign', 'sketch_key').annotate(sketch_count=Count('pk'))
+        histograms = {}
+        for items in run_on_databases(lambda alias: list(qs.using(alias)), databases or [qs.db]):
+            for item in items:
+                histogram = histograms.setdefault((item['heatmap_day'], item['heatmap_hour']),
+                                                  LogHistogram(get_setting('PERCENTILE_ACCURACY')))
+                histogram.add(item['sketch_sign'], int(item['sketch_key']), item['sketch_count'])
+        values = dict((cell, histogram.quantile(aggregate.percentile)) for cell, histogram in histograms.items())
+    elif databases:
+        qs = qs.order_by().values('heatmap_day', 'heatmap_hour')
+        partials = OrderedDict()
+
+        def add_partial(partial, combine):
+            name = 'part%d' % len(partials)
+            partials[name] = (partial, combine)
+            return name
+
+        merge = get_partial_merger(aggregate, add_partial)
+        annotations = dict((name, partial) for name, (partial, combine) in partials.items())
+        cells = {}
+        for items in run_on_databases(lambda alias: list(qs.using(alias).annotate(**annotations)), databases):
+            for item in items:
+                merged = cells.setdefault((item['heatmap_day'], item['heatmap_hour']), {})
+                for name, (partial, combine) in partials.items():
+                    merged[name] = combine(merged.get(name), item[name])
+        values = dict((cell, merge(merged, {})) for cell, merged in cells.items())
+    else:
+        values = dict(((item['heatmap_day'], item['heatmap_hour']), item['value'])
+                      for item in qs.order_by().values('heatmap_day', 'heatmap_hour').annotate(value=aggregate))
+
+    matrix = empty_heatmap()
+    for (day, hour), value in values.items():
+        if day is not None and hour is not None:
+            # ExtractWeekDay counts from Sunday = 1
+            matrix[(day + 5) % 7][hour] = value or 0
+    return matrix
+
+
+def _is_additive(aggregate):
+    """Returns True if ``aggregate`` of records sets adds up"""
+    if isinstance(aggregate, Count):
+        expression = aggregate.get_source_expressions()[0]
+        return not getattr(aggregate, 'distinct', False) or getattr(expression, 'name', None) == 'pk'
+    return isinstance(aggregate, Sum)
+
+
+@instrumentation.timed
+def baseline(qs, date_field, aggregates, start, interval='days', databases=None):
+    """Returns the values of ``aggregates`` over the records before the bucket
+    of ``start``, which cumulative series start from.
+
+    Computed by one aggregate query (one per database). Only counts and sums
+    add up: the values of the other aggregates are 0.
+    """
+    first_bucket = get_bounds(start, interval.rstrip('s'))[0]
+    qs = qs.filter(**{'%s__lt' % date_field: first_bucket})
+    annotations = dict(
+        ('agg%d' % i, aggregate) for i, aggregate in enumerate(aggregates) if _is_additive(aggregate)
+    )
+    totals = [0] * len(aggregates)
+    if annotations:
+        for alias in databases or [None]:
+            values = (qs.using(alias) if alias else qs).aggregate(**annotations)
+            for i in range(len(aggregates)):
+                totals[i] += values.get('agg%d' % i) or 0
+    return tuple(totals)
+
+
+def cumulative_rows(rows, initial=None, aggregates=None):
+    """Returns the running totals of ``rows``, starting from ``initial`` values.
+
+    The columns of the ``aggregates`` which don't add up (averages, maximums,
+    distinct counts...) are left as they are."""
+    totals = list(initial) if initial else [0] * (len(rows[0]) - 1 if rows else 0)
+    additive = [_is_additive(aggregate) for aggregate in aggregates] if aggregates else []
+    result = []
+    for row in rows:
+        totals = [total + (value or 0) for total, value in zip(totals, row[1:])]
+        result.append((row[0],) + tuple(
+            total if i >= len(additive) or additive[i] else value
+            for i, (total, value) in enumerate(zip(totals, row[1:]))))
+    return result
+
+
+def rolling_rows(rows, window, average=False):
+    """Returns the sums (or averages if ``average``) of the last ``window``
+    buckets of ``rows``, fewer for the first buckets"""
+    result = []
+    sums = [0] * (len(rows[0]) - 1 if rows else 0)
+    for i, row in enumerate(rows):
+        sums = [total + (value or 0) for total, value in zip(sums, row[1:])]
+        if i >= window:
+            sums = [total - (value or 0) for total, value in zip(sums, rows[i - window][1:])]
+        count = min(i + 1, window)
+        result.append((row[0],) + tuple(float(total) / count if average else total for total in sums))
+    return result
@@ -0,0 +1,134 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2014 Star2Billing S.L.
+#
+# The Initial Developer of the Original Code is
+# Arezqui Belaid <info@star2billing.com>
+#
+"""Metrics of the dashboard in the Prometheus text format.
+
+The latest bucket of the series of every visible graph, for every chart
+interval and criteria value, is read from the cache (what the dashboard
+computed last): scraping the metrics never runs a series query. Series
+not computed yet are missing. The counters of the process (see
+``admin_tools_stats.instrumentation``) come next.
+"""
+from django.utils.encoding import force_text
+from django.utils.timezone import is_aware, localtime, now
+
+from admin_tools_stats.cache import ALL_USERS, get_data_versions, get_series_many, local_cache, series_cache_key
+from admin_tools_stats.instrumentation import instrumentation
+from admin_tools_stats.modules import DashboardChart
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+INTERVALS = ('hours', 'days', 'weeks', 'months')
+
+
+def escape_label(value):
+    return force_text(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    return '{%s}' % ','.join('%s="%s"' % (name, escape_label(value)) for name, value in labels)
+
+
+def format_value(value):
+    if value is None:
+        return 'NaN'
+    if isinstance(value, float):
+        return repr(value)
+    return force_text(value)
+
+
+def latest_row(rows, today):
+    """Returns the row of the current bucket: the last one not in the future"""
+    if is_aware(today):
+        naive_today = localtime(today).replace(tzinfo=None)
+    else:
+        naive_today = today
+    for row in reversed(rows):
+        if row[0] <= (today if is_aware(row[0]) else naive_today):
+            return row
+    return None
+
+
+def get_charts(graphs):
+    """Returns the ``(conf_data, chart)`` of every interval and criteria value of ``graphs``"""
+    return [
+        (conf_data, DashboardChart(interval=interval, graph_key=conf_data.graph_key, require_chart_jscss=False,
+                                   **{'select_box_' + conf_data.graph_key: select_box_value}))
+        for conf_data in graphs
+        for select_box_value in conf_data.get_select_box_values()
+        for interval in INTERVALS
+    ]
+
+
+def get_series_samples(graphs):
+    """Returns the ``(labels, fresh, values)`` of every cached serie of
+    ``graphs``, ``values`` holding the ``(metric name, value)`` of its
+    latest bucket"""
+    charts = get_charts(graphs)
+    data_versions = get_data_versions([conf_data.graph_key for conf_data in graphs])
+    keys = [series_cache_key(chart.graph_key, chart.interval, chart.days, chart.select_box_value, ALL_USERS)
+            for conf_data, chart in charts]
+    cached_data = get_series_many(keys, dict(
+        (key, data_versions.get(conf_data.graph_key)) for key, (conf_data, chart) in zip(keys, charts)))
+
+    samples = []
+    today = now()
+    for key, (conf_data, chart) in zip(keys, charts):
+        cached = cached_data.get(key)
+        row = latest_row(cached[0], today) if cached is not None else None
+        if row is None:
+            continue
+        if conf_data.group_by_field_name:
+            names = chart.get_breakdown_names(conf_data, None) or []
+        else:
+            names = [name for name, aggregate in conf_data.get_metrics()]
+        labels = (('graph_key', chart.graph_key), ('interval', chart.interval), ('criteria', chart.select_box_value))
+        values = [(names[i] if i < len(names) else i, value) for i, value in enumerate(row[1:])]
+        samples.append((labels, cached[1], values))
+    return samples
+
+
+def render_metrics(graphs):
+    """Returns the metrics of ``graphs`` and of the process"""
+    samples = get_series_samples(graphs)
+    lines = [
+        "# HELP admin_tools_stats_value Latest bucket of the cached series of the dashboard graphs",
+        "# TYPE admin_tools_stats_value gauge",
+    ]
+    for labels, fresh, values in samples:
+        lines += ["admin_tools_stats_value%s %s" % (format_labels(labels + (('metric', name),)), format_value(value))
+                  for name, value in values]
+    lines += [
+        "# HELP admin_tools_stats_fresh Whether the cached serie is fresh (1) or served stale (0)",
+        "# TYPE admin_tools_stats_fresh gauge",
+    ]
+    lines += ["admin_tools_stats_fresh%s %d" % (format_labels(labels), fresh) for labels, fresh, values in samples]
+
+    counters = (
+        ('computations_total', "Series queries run by the process", 'computations'),
+        ('compute_seconds_total', "Seconds spent by the process in series queries", 'compute_seconds'),
+        ('errors_total', "Graphs the process failed to compute", 'errors'),
+    )
+    for name, description, counter in counters:
+        lines += [
+            "# HELP admin_tools_stats_%s %s" % (name, description),
+            "# TYPE admin_tools_stats_%s counter" % name,
+            "admin_tools_stats_%s %s" % (name, format_value(instrumentation.get(counter))),
+        ]
+    lines += [
+        "# HELP admin_tools_stats_cache_reads_total Keys read from the cache by the process",
+        "# TYPE admin_tools_stats_cache_reads_total counter",
+        'admin_tools_stats_cache_reads_total{cache="shared"} %d' % instrumentation.get('shared_cache_reads'),
+        'admin_tools_stats_cache_reads_total{cache="process"} %d' % (local_cache.hits + local_cache.misses),
+        "# HELP admin_tools_stats_cache_hits_total Keys found in the cache by the process",
+        "# TYPE admin_tools_stats_cache_hits_total counter",
+        'admin_tools_stats_cache_hits_total{cache="shared"} %d' % instrumentation.get('shared_cache_hits'),
+        'admin_tools_stats_cache_hits_total{cache="process"} %d' % local_cache.hits,
+    ]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,57 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2014 Star2Billing S.L.
+#
+# The Initial Developer of the Original Code is
+# Arezqui Belaid <info@star2billing.com>
+#
+import threading
+import time
+from functools import wraps
+
+
+class Instrumentation(object):
+    """Counters of the work done by the process, published by the metrics
+    exporter (see ``admin_tools_stats.exporter``)"""
+    names = (
+        # series queries run, and the seconds spent in them
+        'computations', 'compute_seconds',
+        # graphs whose series couldn't be computed
+        'errors',
+        # keys read from the shared cache, and found
+        'shared_cache_reads', 'shared_cache_hits',
+    )
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.values = dict.fromkeys(self.names, 0)
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.values[name] += value
+
+    def get(self, name):
+        return self.values[name]
+
+    def timed(self, function):
+        """Decorates a function running series queries, counting its calls and time"""
+        @wraps(function)
+        def timed_function(*args, **kwargs):
+            started = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.values['computations'] += 1
+                    self.values['compute_seconds'] += time.time() - started
+        return timed_function
+
+
+instrumentation = Instrumentation()
@@ -0,0 +1,39 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2014 Star2Billing S.L.
+#
+# The Initial Developer of the Original Code is
+# Arezqui Belaid <info@star2billing.com>
+#
+from django.core.management.base import BaseCommand, CommandError
+from admin_tools_stats.models import DashboardStats, get_config_errors
+
+
+class Command(BaseCommand):
+    help = "Checks the configuration of the dashboard graphs, without querying their records, " \
+           "and fails if any of them is broken"
+
+    def add_arguments(self, parser):
+        parser.add_argument('graph_keys', nargs='*',
+                            help="graphs to check, all of them by default")
+
+    def handle(self, *args, **options):
+        graph_list = DashboardStats.objects.prefetch_related('criteria', 'metrics').order_by('graph_key')
+        if options['graph_keys']:
+            graph_list = graph_list.filter(graph_key__in=options['graph_keys'])
+
+        # the cached errors are replaced by the ones checked now
+        config_errors = get_config_errors(graph_list, refresh=True)
+        for graph_key, errors in sorted(config_errors.items()):
+            if not errors:
+                self.stdout.write("%s OK" % graph_key)
+                continue
+            for field, error in sorted(errors.items()):
+                self.stdout.write(self.style.ERROR("%s %s: %s" % (graph_key, field, error)))
+
+        broken = len([errors for errors in config_errors.values() if errors])
+        if broken:
+            raise CommandError("%d of %d graphs are misconfigured" % (broken, len(config_errors)))
@@ -0,0 +1,199 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2014 Star2Billing S.L.
+#
+# The Initial Developer of the Original Code is
+# Arezqui Belaid <info@star2billing.com>
+#
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from six.moves.urllib.parse import quote, unquote, urlencode
+try:
+    from django.urls import reverse, NoReverseMatch
+except ImportError:  # Django<2.0
+    from django.core.urlresolvers import reverse, NoReverseMatch
+
+from admin_tools_stats.cache import local_cache
+from admin_tools_stats.modules import get_active_graph
+from admin_tools_stats.utils import CountingCache
+
+INTERVALS = ('hours', 'days', 'weeks', 'months')
+
+
+def percentile(values, fraction):
+    """Returns the nearest-rank percentile of the sorted ``values``, 0 if empty"""
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class Command(BaseCommand):
+    help = "Simulates concurrent staff users browsing the dashboard, and reports the throughput, " \
+           "latencies, database queries and cache hit ratios"
+
+    # simulated actions, with their weight
+    actions = (
+        # the admin index, with every chart
+        ('index', 5),
+        # a chart loaded when its tab is shown
+        ('tab', 3),
+        # a criteria changed: the charts of its graph reloaded
+        ('criteria', 2),
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10,
+                            help="simulated users browsing at once")
+        parser.add_argument('--requests', type=int, default=20,
+                            help="actions of every simulated user")
+        parser.add_argument('--superusers', type=float, default=0.5,
+                            help="share of the simulated users who are superusers, the others being "
+                                 "staff users who see their own data on the graphs filtered by user")
+        parser.add_argument('--host', default='localhost',
+                            help="host the requests are sent to, one of ALLOWED_HOSTS")
+        parser.add_argument('--url', default=None,
+                            help="URL of the dashboard, the admin index by default")
+        parser.add_argument('--seed', type=int, default=0,
+                            help="seed of the simulated actions")
+        parser.add_argument('--clear-cache', action='store_true',
+                            help="start with an empty cache")
+
+    def handle(self, *args, **options):
+        if options['users'] < 1:
+            raise CommandError("At least one simulated user is needed")
+        self.url = options['url'] or reverse('admin:index')
+        self.graphs = self.get_graphs()
+        users = self.get_users(options['users'], options['superusers'])
+        if options['clear_cache']:
+            cache.clear()
+            local_cache.clear()
+
+        results = []
+        local_hits, local_misses = local_cache.hits, local_cache.misses
+        threads = [
+            threading.Thread(target=self.run_user, args=(index, self.get_client(user, options), options, results))
+            for index, user in enumerate(users)
+        ]
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - started
+
+        self.report(users, results, elapsed, local_cache.hits - local_hits, local_cache.misses - local_misses)
+
+    def get_graphs(self):
+        """Returns the chart URLs and criteria values of the visible graphs,
+        an empty list if ``admin_tools_stats.urls`` aren't included"""
+        graphs = []
+        for conf_data in get_active_graph().prefetch_related('criteria'):
+            intervals = INTERVALS + (('heatmap',) if conf_data.draw_heatmap else ())
+            try:
+                urls = [reverse('admin_tools_stats_chart', args=[conf_data.graph_key, interval])
+                        for interval in intervals]
+            except NoReverseMatch:
+                return []
+            graphs.append((conf_data.graph_key, urls, conf_data.get_select_box_values()))
+        return graphs
+
+    def get_users(self, count, superusers):
+        """Returns the ``count`` simulated users, ``superusers`` of them
+        superusers when there are both kinds of active staff users"""
+        User = get_user_model()
+        pools = [
+            list(User.objects.filter(is_active=True, is_staff=True, is_superuser=True).order_by('pk')),
+            list(User.objects.filter(is_active=True, is_staff=True, is_superuser=False).order_by('pk')),
+        ]
+        if not pools[0] and not pools[1]:
+            raise CommandError("There is no active staff user to simulate")
+        superuser_count = int(round(count * superusers))
+        users = []
+        for index in range(count):
+            pool = pools[index >= superuser_count] or pools[index < superuser_count]
+            users.append(pool[index % len(pool)])
+        return users
+
+    def get_client(self, user, options):
+        """Returns a client logged in as ``user``, before the load starts"""
+        client = Client(HTTP_HOST=options['host'])
+        client.force_login(user)
+        return client
+
+    def run_user(self, index, client, options, results):
+        """Runs the actions of a simulated user, adding their results to ``results``"""
+        generator = random.Random(options['seed'] + index)
+        try:
+            for request_index in range(options['requests']):
+                action, urls = self.choose_action(generator, client)
+                for url in urls:
+                    results.append((action,) + self.get(client, url))
+        finally:
+            connection.close()
+
+    def choose_action(self, generator, client):
+        """Returns a random action and the URLs it loads"""
+        action = generator.choice([name for name, weight in self.actions for i in range(weight)])
+        if action == 'index' or not self.graphs:
+            return 'index', [self.url]
+        graph_key, urls, values = generator.choice(self.graphs)
+        value = client.cookies.get('select_box_' + graph_key)
+        value = unquote(value.value) if value is not None else ''
+        if action == 'criteria' and len(values) > 1:
+            value = generator.choice(values)
+            client.cookies['select_box_' + graph_key] = quote(value)
+        else:
+            action = 'tab'
+            urls = [generator.choice(urls)]
+        return action, ['%s?%s' % (url, urlencode({'select_box_value': value})) for url in urls]
+
+    def get(self, client, url):
+        """Returns the (seconds, succeeded, queries, cache reads, cache hits) of a request"""
+        with CaptureQueriesContext(connection) as queries, CountingCache() as cache_operations:
+            started = time.time()
+            try:
+                succeeded = client.get(url).status_code < 400
+            except Exception:
+                succeeded = False
+            elapsed = time.time() - started
+        return elapsed, succeeded, len(queries), cache_operations.reads, cache_operations.hits
+
+    def report(self, users, results, elapsed, local_hits, local_misses):
+        superusers = len([user for user in users if user.is_superuser])
+        self.stdout.write("%d simulated users (%d superusers), %d requests in %.2fs: %.1f requests/s" % (
+            len(users), superusers, len(results), elapsed, len(results) / elapsed if elapsed else 0))
+
+        by_action = OrderedDict((('all', results),))
+        for action, weight in self.actions:
+            by_action[action] = [result for result in results if result[0] == action]
+        self.stdout.write("latency (ms)   requests    p50    p95    p99    max")
+        for action, action_results in by_action.items():
+            latencies = sorted(result[1] * 1000 for result in action_results)
+            self.stdout.write("%-12s %10d %6.0f %6.0f %6.0f %6.0f" % (
+                action, len(latencies), percentile(latencies, 0.5), percentile(latencies, 0.95),
+                percentile(latencies, 0.99), latencies[-1] if latencies else 0))
+
+        errors = len([result for result in results if not result[2]])
+        queries = sum(result[3] for result in results)
+        reads = sum(result[4] for result in results)
+        hits = sum(result[5] for result in results)
+        self.stdout.write("errors: %d" % errors)
+        self.stdout.write("database queries: %d, %.1f per request" % (
+            queries, float(queries) / len(results) if results else 0))
+        self.stdout.write("shared cache hit ratio: %.1f%% of %d keys read" % (
+            100.0 * hits / reads if reads else 0, reads))
+        self.stdout.write("process cache hit ratio: %.1f%% of %d keys read" % (
+            100.0 * local_hits / (local_hits + local_misses) if local_hits + local_misses else 0,
+            local_hits + local_misses))
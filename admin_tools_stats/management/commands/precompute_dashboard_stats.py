@@ -0,0 +1,35 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2014 Star2Billing S.L.
+#
+# The Initial Developer of the Original Code is
+# Arezqui Belaid <info@star2billing.com>
+#
+from django.core.management.base import BaseCommand
+from admin_tools_stats.cache import bump_data_version
+from admin_tools_stats.modules import DashboardCharts, get_active_graph
+
+
+class Command(BaseCommand):
+    help = "Computes the series of the visible dashboard graphs and stores them in the cache"
+
+    def add_arguments(self, parser):
+        parser.add_argument('graph_keys', nargs='*',
+                            help="graphs to compute, all the visible ones by default")
+
+    def handle(self, *args, **options):
+        graph_list = get_active_graph().prefetch_related('criteria', 'metrics')
+        if options['graph_keys']:
+            graph_list = graph_list.filter(graph_key__in=options['graph_keys'])
+
+        for conf_data in graph_list:
+            charts = DashboardCharts(graph_key=conf_data.graph_key, require_chart_jscss=False)
+            for chart in charts.children:
+                for select_box_value in conf_data.get_select_box_values():
+                    chart.refresh_series(conf_data, select_box_value)
+            # expire the charts rendered with the former series
+            bump_data_version(conf_data.graph_key)
+            self.stdout.write("%s computed" % conf_data.graph_key)
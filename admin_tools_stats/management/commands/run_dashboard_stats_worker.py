@@ -0,0 +1,76 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2014 Star2Billing S.L.
+#
+# The Initial Developer of the Original Code is
+# Arezqui Belaid <info@star2billing.com>
+#
+import time
+import traceback
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils.timezone import now
+from admin_tools_stats.models import DashboardStats, DashboardStatsJob
+from admin_tools_stats.modules import DashboardChart, DashboardHeatmap
+
+
+class Command(BaseCommand):
+    help = "Computes the series of the pending dashboard stats jobs and stores them in the cache"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help="exit once there is no pending job")
+        parser.add_argument('--sleep', type=float, default=5,
+                            help="seconds between two polls of the pending jobs")
+        parser.add_argument('--keep', type=float, default=24,
+                            help="hours the finished jobs are kept")
+
+    def handle(self, *args, **options):
+        while True:
+            job = self.claim_job()
+            if job is not None:
+                self.run_job(job)
+                continue
+            DashboardStatsJob.objects.filter(
+                status__in=('done', 'failed'),
+                finished_date__lt=now() - timedelta(hours=options['keep']),
+            ).delete()
+            if options['once']:
+                return
+            time.sleep(options['sleep'])
+
+    def claim_job(self):
+        """Returns the oldest pending job, marked as running, None if there is none.
+
+        A job is claimed by updating its status, so workers never run the same job.
+        Jobs left running by dead workers are pending again once their lease is over."""
+        DashboardStatsJob.release_stale_jobs()
+        for job in DashboardStatsJob.objects.filter(status='pending').order_by('created_date', 'pk')[:10]:
+            started_date = now()
+            if DashboardStatsJob.objects.filter(pk=job.pk, status='pending').update(
+                    status='running', started_date=started_date):
+                job.status = 'running'
+                job.started_date = started_date
+                return job
+        return None
+
+    def run_job(self, job):
+        try:
+            conf_data = DashboardStats.objects.prefetch_related('criteria', 'metrics').get(graph_key=job.graph_key)
+            chart_class = DashboardHeatmap if job.interval == DashboardHeatmap.interval else DashboardChart
+            chart = chart_class(interval=job.interval, days=job.days, graph_key=job.graph_key,
+                                require_chart_jscss=False)
+            chart.store_registrations(conf_data, job.user, job.interval, job.days, job.graph_key,
+                                      job.select_box_value)
+            job.error = getattr(chart, 'error_message', '')
+        except Exception:
+            job.error = traceback.format_exc()
+        job.status = 'failed' if job.error else 'done'
+        job.pending_key = None
+        job.finished_date = now()
+        job.save(update_fields=['status', 'pending_key', 'error', 'finished_date'])
+        self.stdout.write("%s %s" % (job, job.status))
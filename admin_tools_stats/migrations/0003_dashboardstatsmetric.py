@@ -0,0 +1,29 @@
+# Generated by Django 2.2.28 on 2026-10-19 01:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('admin_tools_stats', '0002_auto_20190920_1058'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DashboardStatsMetric',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('metric_name', models.CharField(blank=True, help_text='name of the serie, ex. average duration', max_length=90, null=True, verbose_name='metric name')),
+                ('operation_field_name', models.CharField(help_text='The field you want to aggregate, ex. duration', max_length=90, verbose_name='Operate field name')),
+                ('type_operation_field_name', models.CharField(choices=[('DistinctCount', 'DistinctCount'), ('Count', 'Count'), ('Sum', 'Sum'), ('Avg', 'Avg'), ('Max', 'Max'), ('Min', 'Min'), ('StdDev', 'StdDev'), ('Variance', 'Variance')], help_text='choose the type operation what you want to aggregate, ex. Avg', max_length=90, verbose_name='Choose Type operation')),
+                ('dashboard_stats', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='metrics', to='admin_tools_stats.DashboardStats')),
+            ],
+            options={
+                'verbose_name': 'dashboard stats metric',
+                'verbose_name_plural': 'dashboard stats metrics',
+                'db_table': 'dashboard_stats_metric',
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-19 01:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('admin_tools_stats', '0003_dashboardstatsmetric'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='dashboardstats',
+            name='type_operation_field_name',
+            field=models.CharField(blank=True, choices=[('DistinctCount', 'DistinctCount'), ('Count', 'Count'), ('Sum', 'Sum'), ('Avg', 'Avg'), ('Max', 'Max'), ('Min', 'Min'), ('StdDev', 'StdDev'), ('Variance', 'Variance'), ('P50', 'P50 (median)'), ('P95', 'P95'), ('P99', 'P99')], help_text='choose the type operation what you want to aggregate, ex. Sum', max_length=90, null=True, verbose_name='Choose Type operation'),
+        ),
+        migrations.AlterField(
+            model_name='dashboardstatsmetric',
+            name='type_operation_field_name',
+            field=models.CharField(choices=[('DistinctCount', 'DistinctCount'), ('Count', 'Count'), ('Sum', 'Sum'), ('Avg', 'Avg'), ('Max', 'Max'), ('Min', 'Min'), ('StdDev', 'StdDev'), ('Variance', 'Variance'), ('P50', 'P50 (median)'), ('P95', 'P95'), ('P99', 'P99')], help_text='choose the type operation what you want to aggregate, ex. Avg', max_length=90, verbose_name='Choose Type operation'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-19 01:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('admin_tools_stats', '0004_percentile_operations'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dashboardstats',
+            name='compare_previous_period',
+            field=models.BooleanField(default=False, help_text='draw the previous period (ex. last week) next to the current one', verbose_name='compare with previous period'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-19 01:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('admin_tools_stats', '0005_dashboardstats_compare_previous_period'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dashboardstats',
+            name='precompute_user_series',
+            field=models.BooleanField(default=False, help_text='compute the series of all users in one query grouped by user field', verbose_name='precompute user series'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-19 01:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('admin_tools_stats', '0006_dashboardstats_precompute_user_series'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dashboardstats',
+            name='realtime_counters',
+            field=models.BooleanField(default=False, help_text='count the records of the current hour/day/week/month when they are saved or deleted (Count and Sum of integer fields only)', verbose_name='real-time counters'),
+        ),
+    ]
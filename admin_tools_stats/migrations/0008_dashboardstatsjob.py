@@ -0,0 +1,42 @@
+# Generated by Django 2.2.28 on 2026-10-19 01:49
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('admin_tools_stats', '0007_dashboardstats_realtime_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dashboardstats',
+            name='compute_in_background',
+            field=models.BooleanField(default=False, help_text='compute the series by the run_dashboard_stats_worker command, never while loading the dashboard', verbose_name='compute in background'),
+        ),
+        migrations.CreateModel(
+            name='DashboardStatsJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('graph_key', models.CharField(max_length=90, verbose_name='graph identifier')),
+                ('interval', models.CharField(max_length=10, verbose_name='interval')),
+                ('days', models.PositiveIntegerField(verbose_name='days')),
+                ('select_box_value', models.CharField(blank=True, default='', max_length=255, verbose_name='criteria value')),
+                ('status', models.CharField(choices=[('pending', 'pending'), ('running', 'running'), ('done', 'done'), ('failed', 'failed')], db_index=True, default='pending', max_length=10, verbose_name='status')),
+                ('error', models.TextField(blank=True, default='', verbose_name='error')),
+                ('created_date', models.DateTimeField(auto_now_add=True, verbose_name='date')),
+                ('started_date', models.DateTimeField(blank=True, null=True, verbose_name='started')),
+                ('finished_date', models.DateTimeField(blank=True, null=True, verbose_name='finished')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='user')),
+            ],
+            options={
+                'verbose_name': 'dashboard stats job',
+                'verbose_name_plural': 'dashboard stats jobs',
+                'db_table': 'dashboard_stats_job',
+            },
+        ),
+    ]
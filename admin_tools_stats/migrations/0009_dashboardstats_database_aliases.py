@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-19 01:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('admin_tools_stats', '0008_dashboardstatsjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dashboardstats',
+            name='database_aliases',
+            field=models.CharField(blank=True, default='', help_text='comma separated databases the records are split across (ex. shard1, shard2), the default database if empty', max_length=255, verbose_name='database aliases'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-19 01:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('admin_tools_stats', '0009_dashboardstats_database_aliases'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dashboardstatscriteria',
+            name='discover_dynamic_values',
+            field=models.BooleanField(default=False, help_text='list the values of the dynamic criteria field found in the recent records, labelled by the dynamic criteria mapping when they are in it', verbose_name='discover dynamic values'),
+        ),
+    ]
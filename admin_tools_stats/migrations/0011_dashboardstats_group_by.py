@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-19 01:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('admin_tools_stats', '0010_dashboardstatscriteria_discover_dynamic_values'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dashboardstats',
+            name='group_by_field_name',
+            field=models.CharField(blank=True, help_text='break the first metric down by the most frequent values of this field, ex. carrier', max_length=90, null=True, verbose_name='group by field name'),
+        ),
+        migrations.AddField(
+            model_name='dashboardstats',
+            name='group_by_limit',
+            field=models.PositiveSmallIntegerField(default=10, help_text='values of the group by field drawn, the other ones are drawn together', verbose_name='group by limit'),
+        ),
+    ]
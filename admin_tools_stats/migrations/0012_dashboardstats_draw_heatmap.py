@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-19 02:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('admin_tools_stats', '0011_dashboardstats_group_by'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dashboardstats',
+            name='draw_heatmap',
+            field=models.BooleanField(default=False, help_text='draw also the first metric of the last 4 weeks by day of the week and hour of the day', verbose_name='draw heatmap'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-19 02:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('admin_tools_stats', '0012_dashboardstats_draw_heatmap'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dashboardstats',
+            name='transform',
+            field=models.CharField(blank=True, choices=[('cumulative', 'cumulative sum'), ('moving_average', 'moving average'), ('rolling_sum', 'rolling sum')], default='', help_text='draw the series summed up since the beginning (Count and Sum operations) or over the last buckets', max_length=20, verbose_name='transform'),
+        ),
+        migrations.AddField(
+            model_name='dashboardstats',
+            name='transform_window',
+            field=models.PositiveSmallIntegerField(default=7, help_text='buckets of the moving average and rolling sum', verbose_name='transform window'),
+        ),
+    ]
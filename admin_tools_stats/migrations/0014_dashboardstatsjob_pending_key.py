@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-19 02:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('admin_tools_stats', '0013_dashboardstats_transform'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dashboardstatsjob',
+            name='pending_key',
+            field=models.CharField(blank=True, editable=False, max_length=255, null=True, unique=True, verbose_name='pending key'),
+        ),
+    ]
@@ -8,13 +8,24 @@
 # The Initial Developer of the Original Code is
 # Arezqui Belaid <info@star2billing.com>
 #
+from collections import OrderedDict
+from datetime import timedelta
 
-from django.db import models
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, models
 from django.core.exceptions import FieldError, ValidationError
-from django.utils.encoding import python_2_unicode_compatible
+from django.utils.encoding import force_text, python_2_unicode_compatible
+from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
 from django.apps import apps
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
 import jsonfield.fields
+from admin_tools_stats.app_settings import get_setting
+from admin_tools_stats.cache import config_errors_cache_key, criteria_values_cache_key, expire_graph, \
+    criteria_hash, get_many, set_many
+from admin_tools_stats.engine import get_aggregate, default_aggregate, discover_values
 
 operation = (
     ('DistinctCount', 'DistinctCount'),
@@ -25,6 +36,15 @@ operation = (
     ('Min', 'Min'),
     ('StdDev', 'StdDev'),
     ('Variance', 'Variance'),
+    ('P50', 'P50 (median)'),
+    ('P95', 'P95'),
+    ('P99', 'P99'),
+)
+
+transforms = (
+    ('cumulative', _('cumulative sum')),
+    ('moving_average', _('moving average')),
+    ('rolling_sum', _('rolling sum')),
 )
 
 
@@ -39,6 +59,7 @@ class DashboardStatsCriteria(models.Model):
         * ``criteria_fix_mapping`` - JSON data key-value pairs.
         * ``dynamic_criteria_field_name`` - Dynamic criteria field.
         * ``criteria_dynamic_mapping`` - JSON data key-value pairs.
+        * ``discover_dynamic_values`` - find the dynamic criteria values in the records.
         * ``created_date`` - record created date.
         * ``updated_date`` - record updated date.
 
@@ -63,6 +84,10 @@ class DashboardStatsCriteria(models.Model):
             " Ex. \"{'false': 'Inactive', 'true': 'Active'}\"",
         ),
     )
+    discover_dynamic_values = models.BooleanField(
+        default=False, verbose_name=_("discover dynamic values"),
+        help_text=_("list the values of the dynamic criteria field found in the recent records, "
+                    "labelled by the dynamic criteria mapping when they are in it"))
     created_date = models.DateTimeField(auto_now_add=True, verbose_name=_('date'))
     updated_date = models.DateTimeField(auto_now=True)
 
@@ -87,7 +112,19 @@ class DashboardStats(models.Model):
         * ``model_app_name`` - App name of model.
         * ``model_name`` - model name.
         * ``date_field_name`` - Date field of model_name.
+        * ``user_field_name`` - field restricting the data to the user.
+        * ``precompute_user_series`` - compute all users series at once.
+        * ``group_by_field_name`` - field the graph is broken down by.
+        * ``group_by_limit`` - values of ``group_by_field_name`` drawn, the others summed up.
         * ``criteria`` - many-to-many relationship.
+        * ``metrics`` - additional metrics (see ``DashboardStatsMetric``).
+        * ``compare_previous_period`` - draw also the previous period.
+        * ``draw_heatmap`` - draw also the records by day of the week and hour.
+        * ``transform`` - cumulative sum, moving average or rolling sum of the series.
+        * ``transform_window`` - buckets of the moving average and rolling sum.
+        * ``realtime_counters`` - count the current bucket on model signals.
+        * ``compute_in_background`` - compute the series in background jobs only.
+        * ``database_aliases`` - databases the records are split across.
         * ``is_visible`` - enable/disable.
         * ``created_date`` - record created date.
         * ``updated_date`` - record updated date.
@@ -115,7 +152,41 @@ class DashboardStats(models.Model):
     type_operation_field_name = models.CharField(max_length=90, verbose_name=_("Choose Type operation"),
                                       null=True, blank=True, choices=operation,
                                       help_text=_("choose the type operation what you want to aggregate, ex. Sum"))
+    precompute_user_series = models.BooleanField(
+        default=False, verbose_name=_("precompute user series"),
+        help_text=_("compute the series of all users in one query grouped by user field"))
+    group_by_field_name = models.CharField(
+        max_length=90, null=True, blank=True, verbose_name=_("group by field name"),
+        help_text=_("break the first metric down by the most frequent values of this field, ex. carrier"))
+    group_by_limit = models.PositiveSmallIntegerField(
+        default=10, verbose_name=_("group by limit"),
+        help_text=_("values of the group by field drawn, the other ones are drawn together"))
     criteria = models.ManyToManyField(DashboardStatsCriteria, blank=True)
+    compare_previous_period = models.BooleanField(
+        default=False, verbose_name=_("compare with previous period"),
+        help_text=_("draw the previous period (ex. last week) next to the current one"))
+    transform = models.CharField(
+        max_length=20, blank=True, default='', choices=transforms, verbose_name=_("transform"),
+        help_text=_("draw the series summed up since the beginning (Count and Sum operations) "
+                    "or over the last buckets"))
+    transform_window = models.PositiveSmallIntegerField(
+        default=7, verbose_name=_("transform window"),
+        help_text=_("buckets of the moving average and rolling sum"))
+    draw_heatmap = models.BooleanField(
+        default=False, verbose_name=_("draw heatmap"),
+        help_text=_("draw also the first metric of the last 4 weeks by day of the week and hour of the day"))
+    realtime_counters = models.BooleanField(
+        default=False, verbose_name=_("real-time counters"),
+        help_text=_("count the records of the current hour/day/week/month when they are saved or deleted "
+                    "(Count and Sum of integer fields only)"))
+    compute_in_background = models.BooleanField(
+        default=False, verbose_name=_("compute in background"),
+        help_text=_("compute the series by the run_dashboard_stats_worker command, never while loading "
+                    "the dashboard"))
+    database_aliases = models.CharField(
+        max_length=255, blank=True, default='', verbose_name=_("database aliases"),
+        help_text=_("comma separated databases the records are split across (ex. shard1, shard2), "
+                    "the default database if empty"))
     is_visible = models.BooleanField(default=True, verbose_name=_('visible'))
     created_date = models.DateTimeField(auto_now_add=True, verbose_name=_('date'))
     updated_date = models.DateTimeField(auto_now=True)
@@ -127,6 +198,15 @@ class DashboardStats(models.Model):
         verbose_name_plural = _("dashboard stats")
 
     def clean(self, *args, **kwargs):
+        errors = self.check_config(relations=False)
+        if errors:
+            raise ValidationError(errors)
+        return super(DashboardStats, self).clean(*args, **kwargs)
+
+    def check_config(self, relations=True):
+        """Returns the errors of the configuration by field, without querying
+        the records: the model, its fields, the aggregates and the databases,
+        and with ``relations`` the criteria and the additional metrics."""
         errors = {}
         model = None
         try:
@@ -139,22 +219,298 @@ class DashboardStats(models.Model):
         except LookupError as e:
             errors['model_name'] = str(e)
 
-        try:
-            if model and self.operation_field_name:
-                model.objects.all().query.resolve_ref(self.operation_field_name)
-        except FieldError as e:
-            errors['operation_field_name'] = str(e)
+        for field in ('operation_field_name', 'date_field_name', 'group_by_field_name', 'user_field_name'):
+            try:
+                if model and getattr(self, field):
+                    model.objects.all().query.resolve_ref(getattr(self, field))
+            except FieldError as e:
+                errors[field] = str(e)
 
-        try:
-            if model and self.date_field_name:
-                model.objects.all().query.resolve_ref(self.date_field_name)
-        except FieldError as e:
-            errors['date_field_name'] = str(e)
+        if model and self.type_operation_field_name and self.operation_field_name and \
+                'operation_field_name' not in errors:
+            try:
+                model.objects.annotate(checked_value=get_aggregate(self.type_operation_field_name,
+                                                                   self.operation_field_name))
+            except (KeyError, FieldError, TypeError, ValueError) as e:
+                errors['type_operation_field_name'] = str(e)
 
-        raise ValidationError(errors)
-        return super(DashboardStats, self).clean(*args, **kwargs)
+        for alias in self.get_databases():
+            if alias not in connections.databases:
+                errors['database_aliases'] = force_text(_("database '%s' isn't configured") % alias)
+
+        if model and relations and self.pk:
+            for metric in self.metrics.all():
+                try:
+                    model.objects.annotate(checked_value=metric.get_aggregate())
+                except (KeyError, FieldError, TypeError, ValueError) as e:
+                    errors['metrics'] = u"%s: %s" % (metric.get_name(), e)
+            for criteria in self.criteria.all():
+                try:
+                    model.objects.filter(**(criteria.criteria_fix_mapping or {}))
+                    if criteria.dynamic_criteria_field_name:
+                        values = [value for value in criteria.criteria_dynamic_mapping or {} if value]
+                        for value in values[:1]:
+                            model.objects.filter(**{criteria.dynamic_criteria_field_name: value})
+                        if not values:
+                            model.objects.all().query.resolve_ref(criteria.dynamic_criteria_field_name)
+                except (FieldError, TypeError, ValueError, ValidationError) as e:
+                    errors['criteria'] = u"%s: %s" % (criteria.criteria_name, e)
+        return errors
+
+    def get_databases(self):
+        """Returns the aliases of the databases the records are split across,
+        an empty list for the default database"""
+        return [alias.strip() for alias in (self.database_aliases or '').split(',') if alias.strip()]
+
+    def get_metrics(self):
+        """Returns the ``(name, aggregate)`` pairs computed for this graph.
+
+        The operation configured on the graph itself comes first, followed
+        by the additional metrics, so they can all be computed together in
+        one aggregate query.
+        """
+        if self.type_operation_field_name and self.operation_field_name:
+            main_name = u"%s %s" % (self.type_operation_field_name, self.operation_field_name)
+            main_aggregate = get_aggregate(self.type_operation_field_name, self.operation_field_name)
+        else:
+            main_name = u"Count"
+            main_aggregate = default_aggregate()
+        metrics = [(main_name, main_aggregate)]
+        for metric in self.metrics.all():
+            metrics.append((metric.get_name(), metric.get_aggregate()))
+        return metrics
+
+    def get_filter_kwargs(self, select_box_value, user=None):
+        """Returns the filter of the records aggregated on the graph"""
+        kwargs = {}
+        if user is not None:
+            kwargs[self.user_field_name] = user
+        for i in self.criteria.all():
+            # fixed mapping value passed info kwargs
+            if i.criteria_fix_mapping:
+                for key in i.criteria_fix_mapping:
+                    # value => i.criteria_fix_mapping[key]
+                    kwargs[key] = i.criteria_fix_mapping[key]
+
+            # dynamic mapping value passed info kwargs
+            if i.dynamic_criteria_field_name and select_box_value:
+                kwargs[i.dynamic_criteria_field_name] = select_box_value
+        return kwargs
+
+    def get_select_box_values(self):
+        """Returns the values of the dynamic criteria select box, '' for all"""
+        values = ['']
+        for criteria in self.criteria.all():
+            if criteria.dynamic_criteria_field_name:
+                values.extend(self.get_dynamic_mapping(criteria).keys())
+        return values
+
+    def get_dynamic_mapping(self, criteria):
+        """Returns the values of the dynamic criteria select box with their labels.
+
+        When the values are discovered, they are the ones found in the recent
+        records, labelled by ``criteria_dynamic_mapping`` if mapped there.
+        """
+        mapping = criteria.criteria_dynamic_mapping or {}
+        if not (criteria.discover_dynamic_values and criteria.dynamic_criteria_field_name):
+            return mapping
+        discovered = OrderedDict()
+        if '' in mapping:
+            discovered[''] = mapping['']
+        for value in self.get_discovered_values().get(criteria.pk, []):
+            discovered[value] = mapping.get(value, value)
+        return discovered
+
+    def get_discovered_values(self):
+        """Returns the values of the discovered dynamic criteria by criteria pk.
 
+        They are looked up in the records of the last ``CRITERIA_VALUES_DAYS``
+        days, and cached for ``CRITERIA_VALUES_TIMEOUT`` seconds.
+        """
+        key = criteria_values_cache_key(self.graph_key)
+        values = cache.get(key)
+        if values is not None:
+            return values
 
+        values = {}
+        begin = now() - timedelta(days=get_setting('CRITERIA_VALUES_DAYS'))
+        filter_kwargs = self.get_filter_kwargs('')
+        for criteria in self.criteria.all():
+            if not (criteria.discover_dynamic_values and criteria.dynamic_criteria_field_name):
+                continue
+            try:
+                model = apps.get_model(self.model_app_name, self.model_name)
+                queryset = model.objects.filter(**{self.date_field_name + '__gte': begin}).filter(**filter_kwargs)
+                found = discover_values(queryset, criteria.dynamic_criteria_field_name,
+                                        get_setting('CRITERIA_VALUES_LIMIT'), self.get_databases())
+            except (LookupError, FieldError, TypeError, ValueError):
+                found = []
+            values[criteria.pk] = [force_text(value) for value in found]
+        cache.set(key, values, get_setting('CRITERIA_VALUES_TIMEOUT'))
+        return values
 
     def __str__(self):
             return u"%s" % self.graph_key
+
+
+def get_config_errors(graphs, data_versions=None, refresh=False):
+    """Returns the configuration errors of ``graphs`` by graph key (see
+    ``DashboardStats.check_config``).
+
+    They are checked once and cached, broken configurations included, until
+    the graph changes or ``CONFIG_ERRORS_TIMEOUT`` seconds; ``refresh``
+    checks them again. Given the ``data_versions`` of the graphs, they are
+    kept in the process cache too."""
+    keys = dict((config_errors_cache_key(graph.graph_key), graph) for graph in graphs)
+    stamps = None
+    if data_versions is not None:
+        stamps = dict((key, data_versions.get(graph.graph_key)) for key, graph in keys.items())
+    cached_errors = {} if refresh else get_many(list(keys), stamps)
+    checked_errors = dict(
+        (key, graph.check_config()) for key, graph in keys.items() if key not in cached_errors
+    )
+    if checked_errors:
+        set_many(checked_errors, get_setting('CONFIG_ERRORS_TIMEOUT'), stamps)
+    cached_errors.update(checked_errors)
+    return dict((graph.graph_key, cached_errors[key]) for key, graph in keys.items())
+
+
+@python_2_unicode_compatible
+class DashboardStatsMetric(models.Model):
+    """To configure additional metrics of a dashboard graph
+
+    **Attributes**:
+
+        * ``dashboard_stats`` - graph the metric is drawn on.
+        * ``metric_name`` - name of the serie.
+        * ``operation_field_name`` - field to aggregate.
+        * ``type_operation_field_name`` - type of operation.
+
+    **Name of DB table**: dashboard_stats_metric
+    """
+    dashboard_stats = models.ForeignKey(DashboardStats, related_name='metrics',
+                                        on_delete=models.CASCADE)
+    metric_name = models.CharField(max_length=90, verbose_name=_("metric name"),
+                                   null=True, blank=True,
+                                   help_text=_("name of the serie, ex. average duration"))
+    operation_field_name = models.CharField(max_length=90, verbose_name=_("Operate field name"),
+                                            help_text=_("The field you want to aggregate, ex. duration"))
+    type_operation_field_name = models.CharField(max_length=90, verbose_name=_("Choose Type operation"),
+                                                 choices=operation,
+                                                 help_text=_("choose the type operation what you want to aggregate, ex. Avg"))
+
+    class Meta:
+        app_label = "admin_tools_stats"
+        db_table = u'dashboard_stats_metric'
+        verbose_name = _("dashboard stats metric")
+        verbose_name_plural = _("dashboard stats metrics")
+
+    def get_name(self):
+        return self.metric_name or u"%s %s" % (self.type_operation_field_name, self.operation_field_name)
+
+    def get_aggregate(self):
+        return get_aggregate(self.type_operation_field_name, self.operation_field_name)
+
+    def __str__(self):
+            return self.get_name()
+
+
+job_status = (
+    ('pending', _('pending')),
+    ('running', _('running')),
+    ('done', _('done')),
+    ('failed', _('failed')),
+)
+
+
+@python_2_unicode_compatible
+class DashboardStatsJob(models.Model):
+    """Computation of a graph serie by ``run_dashboard_stats_worker``
+
+    **Attributes**:
+
+        * ``graph_key`` - graph to compute.
+        * ``interval`` - hours, days, weeks or months.
+        * ``days`` - range of the serie.
+        * ``select_box_value`` - dynamic criteria value.
+        * ``user`` - user whose data is computed, all the data if empty.
+        * ``status`` - pending, running, done or failed.
+        * ``pending_key`` - unique key of the job while pending or running.
+        * ``error`` - why the job failed.
+        * ``created_date`` - record created date.
+        * ``started_date`` - computation start date.
+        * ``finished_date`` - computation end date.
+
+    **Name of DB table**: dashboard_stats_job
+    """
+    graph_key = models.CharField(max_length=90, verbose_name=_('graph identifier'))
+    interval = models.CharField(max_length=10, verbose_name=_('interval'))
+    days = models.PositiveIntegerField(verbose_name=_('days'))
+    select_box_value = models.CharField(max_length=255, blank=True, default='',
+                                        verbose_name=_('criteria value'))
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.CASCADE,
+                             verbose_name=_('user'))
+    status = models.CharField(max_length=10, choices=job_status, default='pending', db_index=True,
+                              verbose_name=_('status'))
+    pending_key = models.CharField(max_length=255, null=True, blank=True, unique=True, editable=False,
+                                   verbose_name=_('pending key'))
+    error = models.TextField(blank=True, default='', verbose_name=_('error'))
+    created_date = models.DateTimeField(auto_now_add=True, verbose_name=_('date'))
+    started_date = models.DateTimeField(null=True, blank=True, verbose_name=_('started'))
+    finished_date = models.DateTimeField(null=True, blank=True, verbose_name=_('finished'))
+
+    class Meta:
+        app_label = "admin_tools_stats"
+        db_table = u'dashboard_stats_job'
+        verbose_name = _("dashboard stats job")
+        verbose_name_plural = _("dashboard stats jobs")
+
+    @classmethod
+    def enqueue(cls, graph_key, interval, days, select_box_value, user=None):
+        """Adds a pending job, unless the same one is already pending or running.
+
+        The jobs are unique by ``pending_key`` until they are finished, so
+        concurrent requests add a single job."""
+        pending_key = '%s:%s:%s:%s:%s' % (graph_key, interval, days, criteria_hash(select_box_value),
+                                          user.pk if user is not None else '')
+        job, _ = cls.objects.get_or_create(pending_key=pending_key, defaults={
+            'graph_key': graph_key,
+            'interval': interval,
+            'days': days,
+            'select_box_value': select_box_value or '',
+            'user': user,
+        })
+        return job
+
+    @classmethod
+    def release_stale_jobs(cls):
+        """Makes the jobs running for more than ``JOB_LEASE_TIMEOUT`` seconds
+        pending again, their worker having died"""
+        return cls.objects.filter(
+            status='running', started_date__lt=now() - timedelta(seconds=get_setting('JOB_LEASE_TIMEOUT')),
+        ).update(status='pending', started_date=None)
+
+    def __str__(self):
+        return u"%s %s %s" % (self.graph_key, self.interval, self.select_box_value)
+
+
+@receiver([post_save, post_delete], sender=DashboardStats)
+def dashboard_stats_changed(sender, instance, **kwargs):
+    expire_graph(instance.graph_key)
+
+
+@receiver([post_save, post_delete], sender=DashboardStatsMetric)
+def dashboard_stats_metric_changed(sender, instance, **kwargs):
+    expire_graph(instance.dashboard_stats.graph_key)
+
+
+@receiver([post_save, post_delete], sender=DashboardStatsCriteria)
+def dashboard_stats_criteria_changed(sender, instance, **kwargs):
+    for graph_key in DashboardStats.objects.filter(criteria=instance).values_list('graph_key', flat=True):
+        expire_graph(graph_key)
+
+
+@receiver(m2m_changed, sender=DashboardStats.criteria.through)
+def dashboard_stats_criteria_set(sender, instance, action, **kwargs):
+    if action.startswith('post_') and isinstance(instance, DashboardStats):
+        expire_graph(instance.graph_key)
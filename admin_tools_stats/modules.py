@@ -9,7 +9,6 @@
 # The Initial Developer of the Original Code is
 # Arezqui Belaid <info@star2billing.com>
 #
-from django.db.models.aggregates import Count, Sum, Avg, Max, Min, StdDev, Variance
 from django.contrib.auth import get_user_model
 from django.utils.translation import ugettext_lazy as _
 from django.apps import apps
@@ -18,12 +17,35 @@ try:  # Python 3
 except ImportError:  # Python 2
     from django.utils.encoding import force_unicode as force_text
 from django.contrib import messages
+try:
+    from django.urls import reverse, NoReverseMatch
+except ImportError:  # Django<2.0
+    from django.core.urlresolvers import reverse, NoReverseMatch
+from six.moves.urllib.parse import unquote
+from django.core.cache import cache
 from django.core.exceptions import FieldError
+from django.utils.dates import WEEKDAYS_ABBR
+from django.utils.html import conditional_escape, format_html_join
 from django.utils.safestring import mark_safe
-from qsstats import QuerySetStats
+from django.utils.translation import get_language
+from django.template.loader import render_to_string
 from cache_utils.decorators import cached
 from admin_tools.dashboard import modules
-from admin_tools_stats.models import DashboardStats
+from admin_tools_stats.models import DashboardStats, DashboardStatsJob, get_config_errors
+from admin_tools_stats.app_settings import get_setting
+from admin_tools_stats.batch import DashboardStatsBatch
+from admin_tools_stats.cache import ALL_USERS, NO_DATA_USERS, get_user_scope, series_cache_key, \
+    fragment_cache_key, get_data_versions, get_many, set_many, get_scope_series, get_series_many, set_series_many, \
+    breakdown_cache_key, set_breakdown_groups, baseline_cache_key, dashboard_stats_cache_key
+from admin_tools_stats.cost import ADMIT, BACKGROUND, REFUSE, get_admission
+from admin_tools_stats.instrumentation import instrumentation
+from admin_tools_stats.profiling import profiled
+from admin_tools_stats.semaphore import BUSY, query_slot
+from admin_tools_stats.realtime import seed_counters, merge_counters
+from admin_tools_stats.engine import time_series, grouped_time_series, breakdown_time_series, \
+    empty_time_series, default_aggregate, get_buckets, heatmap, empty_heatmap, baseline, cumulative_rows, rolling_rows
+from dateutil.relativedelta import relativedelta
+from qsstats.utils import get_bounds
 from datetime import datetime, timedelta
 
 import time
@@ -56,6 +78,10 @@ class DashboardChart(modules.DashboardModule):
     graph_key = None
     filter_list = None
     chart_container = None
+    batch = None
+    fragment_template = 'admin_tools_stats/modules/chart_fragment.html'
+    # whether the batch fetches the series with the other charts
+    batch_series = True
 
     def is_empty(self):
         return False
@@ -78,75 +104,390 @@ class DashboardChart(modules.DashboardModule):
 
         if self.days is None:
             self.days = self.get_day_intervals()
+        self.chart_container = self.interval + '_' + self.graph_key
+        # add string into href attr
+        self.id = self.chart_container
+        self.fragment = None
+        self.stale = False
+        self.breakdown_names = None
+        if self.batch is not None:
+            self.batch.add_chart(self)
 
     def init_with_context(self, context):
+        # the group and the dashboard template both initialize their modules
+        if self._initialized:
+            return
+        self._initialized = True
         super(DashboardChart, self).init_with_context(context)
-        request = context['request']
-
-        self.data = self.get_registrations(request.user, self.interval, self.days,
-                                           self.graph_key, self.select_box_value)
+        self.render_fragment(context['request'])
+
+    @profiled
+    def render_fragment(self, request):
+        """ Renders the chart for the user of ``request``, or reads it from
+        the cache """
+        config_errors = self.get_config_errors()
+        if config_errors:
+            self.show_config_errors(config_errors)
+            return
+
+        if self.batch is not None:
+            cached_fragment = self.batch.get_fragment(self, request.user)
+            fragment_key = self.get_fragment_cache_key(request.user, self.batch.get_data_versions())
+        else:
+            fragment_key = self.get_fragment_cache_key(request.user, get_data_versions([self.graph_key]))
+            # the key holds the data version
+            cached_fragment = get_many([fragment_key], {fragment_key: None}).get(fragment_key) if fragment_key else None
+        if cached_fragment is not None:
+            self.form_field, self.fragment = cached_fragment
+            return
+
+        self.data = self.get_data(request.user)
         self.prepare_template_data(self.data, self.graph_key, self.select_box_value, self.other_select_box_values)
+        self.fragment = render_to_string(self.fragment_template, {'module': self})
 
         if hasattr(self, 'error_message'):
             messages.add_message(request, messages.ERROR, "%s dashboard: %s" % (self.title, self.error_message))
+        elif fragment_key and not self.pre_content and not self.stale:
+            set_many({fragment_key: (self.form_field, self.fragment)}, get_setting('CACHE_TIMEOUT'),
+                     {fragment_key: None})
+
+    def get_data(self, user):
+        """ Returns the rows drawn for ``user``, with the current bucket
+        counted in real time if enabled """
+        if self.batch is not None:
+            data = self.batch.get_registrations(self, user)
+        else:
+            data = self.get_registrations(user, self.interval, self.days, self.graph_key, self.select_box_value)
+        conf_data = self.get_conf_data()
+        if conf_data is not None and get_user_scope(conf_data, user) == ALL_USERS:
+            data = merge_counters(conf_data, self.interval, self.select_box_value, data)
+        if conf_data is not None and conf_data.group_by_field_name:
+            self.breakdown_names = self.get_breakdown_names(conf_data, user)
+        if conf_data is not None and conf_data.transform:
+            data = self.transform_rows(conf_data, user, data)
+        return data
+
+    def transform_rows(self, conf_data, user, rows):
+        """ Returns the cumulative sums, moving averages or rolling sums of
+        the rows, as configured on the graph """
+        if conf_data.transform == 'cumulative':
+            aggregates = [aggregate for name, aggregate in conf_data.get_metrics()]
+            if conf_data.group_by_field_name:
+                # every series of the breakdown holds the first metric
+                aggregates = aggregates[:1] * (len(rows[0]) - 1 if rows else 0)
+            return cumulative_rows(rows, self.get_baseline(conf_data, user), aggregates)
+        if conf_data.transform in ('moving_average', 'rolling_sum'):
+            return rolling_rows(rows, conf_data.transform_window, average=conf_data.transform == 'moving_average')
+        return rows
+
+    def get_baseline(self, conf_data, user):
+        """ Returns the values of the metrics before the chart range, which
+        cumulative rows start from, cached like the rows. None for the rows
+        broken down by a field, if the graph is broken or if the baseline
+        can't be computed now: it is then admitted like the rows, computed
+        by the background worker or once the database is less busy. """
+        if conf_data.group_by_field_name:
+            return None
+        scope = get_user_scope(conf_data, user)
+        values = cache.get(baseline_cache_key(self.graph_key, self.interval, self.days, self.select_box_value, scope))
+        if values is not None:
+            return values
+
+        admission = self.get_admission(conf_data)
+        if admission == BACKGROUND:
+            DashboardStatsJob.enqueue(self.graph_key, self.interval, self.days, self.select_box_value,
+                                      user if scope != ALL_USERS else None)
+        if admission != ADMIT:
+            self.stale = True
+            return None
+        # the rows are drawn from zero rather than waiting for the busy database
+        with query_slot(wait=False) as acquired:
+            if not acquired:
+                self.stale = True
+                return None
+            return self.store_baseline(conf_data, user, self.days, self.select_box_value)
+
+    def store_baseline(self, conf_data, user, days, select_box_value):
+        """ Computes the values of ``get_baseline`` and caches them """
+        scope = get_user_scope(conf_data, user)
+        begin, end = self.get_query_range(conf_data, days)
+        try:
+            values = baseline(self.get_queryset(conf_data, select_box_value, user if scope != ALL_USERS else None),
+                              conf_data.date_field_name, [aggregate for name, aggregate in conf_data.get_metrics()],
+                              begin, self.interval, databases=conf_data.get_databases())
+        except (LookupError, FieldError, TypeError):
+            # reported with the rows
+            return None
+        cache.set(baseline_cache_key(conf_data.graph_key, self.interval, days, select_box_value, scope),
+                  values, get_setting('CACHE_TIMEOUT'))
+        return values
+
+    def get_breakdown_names(self, conf_data, user):
+        """ Returns the names of the series of a graph broken down by a field:
+        its top values and the other ones, None if unknown """
+        groups = cache.get(breakdown_cache_key(self.graph_key, self.interval, self.days, self.select_box_value,
+                                               get_user_scope(conf_data, user)))
+        if groups is None:
+            return None
+        return groups + [force_text(_('other'))]
+
+    def get_fragment_cache_key(self, user, data_versions):
+        """ Returns the cache key of the rendered chart, which changes with
+        the criteria, the user scope, the language and the graph data version.
+        None if the chart isn't cached, its current bucket counted in real time """
+        conf_data = self.get_conf_data()
+        if conf_data is not None and conf_data.realtime_counters:
+            return None
+        scope = get_user_scope(conf_data, user)
+        criteria = (self.select_box_value, sorted(self.other_select_box_values.items()))
+        return fragment_cache_key(self.graph_key, self.interval, self.days, criteria, scope,
+                                  get_language(), data_versions.get(self.graph_key))
+
+    def get_conf_data(self):
+        """ Returns the graph configuration, shared by the batch if any """
+        if self.batch is not None:
+            return self.batch.get_conf_data(self.graph_key)
+        return get_dashboard_stats(self.graph_key)
+
+    def get_config_errors(self):
+        """ Returns the errors of the graph configuration by field, checked
+        once and cached """
+        if self.batch is not None:
+            return self.batch.get_config_errors(self.graph_key)
+        conf_data = self.get_conf_data()
+        if conf_data is None:
+            return {'graph_key': "Graph '%s' doesn't exist" % self.graph_key}
+        return get_config_errors([conf_data])[self.graph_key]
+
+    def show_config_errors(self, config_errors):
+        """ Shows the errors of the graph configuration instead of the chart,
+        which isn't computed """
+        self.pre_content = _("This graph is misconfigured: %s") % "; ".join(
+            "%s: %s" % (field, error) for field, error in sorted(config_errors.items()))
+        self.form_field = ''
+        self.fragment = ''
+
+    def get_criteria_field(self, graph_key, select_box_value, other_select_box_values):
+        """ Returns the select boxes of the dynamic criteria, from the shared
+        graph configuration """
+        conf_data = self.get_conf_data()
+        if conf_data is None:
+            return get_dynamic_criteria(graph_key, select_box_value, other_select_box_values)
+        return render_dynamic_criteria(conf_data, select_box_value, other_select_box_values)
+
+    def get_data_url(self):
+        """ Returns the URL refreshing the chart for another criteria value,
+        None if ``admin_tools_stats.urls`` aren't included """
+        try:
+            return reverse('admin_tools_stats_chart', args=[self.graph_key, self.interval])
+        except NoReverseMatch:
+            return None
+
+    def get_time_range(self, days, today=None):
+        """ Returns the (begin, end) dates covered by the chart """
+        today = today or now()
+        if days == 24:
+            begin = today - timedelta(hours=days - 1)
+            return begin, today + timedelta(hours=1)
+
+        begin = today - timedelta(days=days - 1)
+        return begin, today + timedelta(days=1)
+
+    def get_period_buckets(self, days, today=None):
+        """ Returns the number of buckets of the period covered by the
+        chart, without the bucket its range ends in after today """
+        today = today or now()
+        begin, end = self.get_time_range(days, today)
+        return len(get_buckets(begin, today, self.interval))
+
+    def get_query_range(self, conf_data, days, today=None):
+        """ Returns the (begin, end) dates queried for the chart, starting
+        as many buckets earlier as the period holds if it is compared with
+        the previous period """
+        today = today or now()
+        begin, end = self.get_time_range(days, today)
+        if conf_data.compare_previous_period:
+            begin = get_bounds(begin, self.interval.rstrip('s'))[0] - \
+                relativedelta(**{self.interval: self.get_period_buckets(days, today)})
+        return begin, end
+
+    def get_queryset(self, conf_data, select_box_value, user=None):
+        """ Returns the records aggregated on the graph, only those of
+        ``user`` if given """
+        model_name = apps.get_model(conf_data.model_app_name, conf_data.model_name)
+        kwargs = self.get_filter_kwargs(conf_data, select_box_value, user)
+        return model_name.objects.filter(**kwargs).distinct()
+
+    def get_filter_kwargs(self, conf_data, select_box_value, user=None):
+        """ Returns the filter of the records aggregated on the graph """
+        return conf_data.get_filter_kwargs(select_box_value, user)
 
-    @cached(60 * 5)
     def get_registrations(self, user, interval, days, graph_key, select_box_value):
-        """ Returns an array with new users count per interval."""
+        """ Returns an array of (date, value, ...) rows per interval,
+        with one value per metric of the graph.
+
+        When the graph is compared with the previous period, the rows
+        cover both periods. Rows are cached per user scope, so users who
+        see all the data share the same rows."""
+        conf_data = self.get_conf_data()
+        scope = get_user_scope(conf_data, user)
+        keys = [series_cache_key(graph_key, interval, days, select_box_value, scope)]
+        if scope != ALL_USERS:
+            keys.append(series_cache_key(graph_key, interval, days, select_box_value, NO_DATA_USERS))
+        cached = get_scope_series(get_series_many(keys), keys, scope)
+        if cached is not None and cached[1]:
+            return cached[0]
+
+        admission = self.get_admission(conf_data)
+        if admission == BACKGROUND:
+            DashboardStatsJob.enqueue(graph_key, interval, days, select_box_value,
+                                      user if scope != ALL_USERS else None)
+            if cached is not None:
+                self.stale = True
+                return cached[0]
+        if admission != ADMIT:
+            return self.refuse_registrations(conf_data, admission, interval, days)
+        # serve the stale rows rather than waiting for the busy database
+        with query_slot(wait=cached is None) as acquired:
+            if not acquired:
+                return self.get_stale_registrations(cached[0] if cached else None, conf_data, interval, days)
+            return self.store_registrations(conf_data, user, interval, days, graph_key, select_box_value)
+
+    def store_registrations(self, conf_data, user, interval, days, graph_key, select_box_value):
+        """ Computes the rows of ``get_registrations`` and caches them """
+        scope = get_user_scope(conf_data, user)
+        data = None
+        if scope != ALL_USERS and conf_data.precompute_user_series and not conf_data.group_by_field_name:
+            data = self.precompute_user_series(conf_data, interval, days, select_box_value).get(scope)
+        if data is None:
+            data = self.compute_registrations(conf_data, user, interval, days, select_box_value)
+            set_series_many({series_cache_key(graph_key, interval, days, select_box_value, scope): data})
+        if conf_data.transform == 'cumulative' and not conf_data.group_by_field_name:
+            self.store_baseline(conf_data, user, days, select_box_value)
+        return data
+
+    def get_stale_registrations(self, rows, conf_data, interval, days):
+        """ Returns the stale ``rows`` while the database is busy, or empty
+        rows if there are none """
+        if rows is None:
+            return self.refuse_registrations(conf_data, BUSY, interval, days)
+        self.stale = True
+        return rows
+
+    def get_admission(self, conf_data):
+        """ Returns how the series of the graph can be computed, from the
+        cost of its records over the longest chart range """
+        def get_queryset():
+            begin, end = self.get_query_range(conf_data, 30 * 2)
+            return self.get_queryset(conf_data, '').filter(
+                **{'%s__range' % conf_data.date_field_name: (begin, end)})
+        if conf_data is None:
+            return ADMIT
         try:
-            conf_data = DashboardStats.objects.get(graph_key=graph_key)
-            model_name = apps.get_model(conf_data.model_app_name, conf_data.model_name)
-            kwargs = {}
-            if not user.is_superuser and conf_data.user_field_name:
-                kwargs[conf_data.user_field_name] = user
-            for i in conf_data.criteria.all():
-                # fixed mapping value passed info kwargs
-                if i.criteria_fix_mapping:
-                    for key in i.criteria_fix_mapping:
-                        # value => i.criteria_fix_mapping[key]
-                        kwargs[key] = i.criteria_fix_mapping[key]
-
-                # dynamic mapping value passed info kwargs
-                if i.dynamic_criteria_field_name and select_box_value:
-                    kwargs[i.dynamic_criteria_field_name] = select_box_value
-
-            aggregate = None
-            if conf_data.type_operation_field_name and conf_data.operation_field_name:
-                operation = {
-                    'DistinctCount': Count(conf_data.operation_field_name, distinct=True),
-                    'Count': Count(conf_data.operation_field_name),
-                    'Sum': Sum(conf_data.operation_field_name),
-                    'Avg': Avg(conf_data.operation_field_name),
-                    'StdDev': StdDev(conf_data.operation_field_name),
-                    'Max': Max(conf_data.operation_field_name),
-                    'Min': Min(conf_data.operation_field_name),
-                    'Variance': Variance(conf_data.operation_field_name),
-                }
-                aggregate = operation[conf_data.type_operation_field_name]
-
-            stats = QuerySetStats(model_name.objects.filter(**kwargs).distinct(),
-                                  conf_data.date_field_name, aggregate)
-            # stats = QuerySetStats(User.objects.filter(is_active=True), 'date_joined')
-            today = now()
-            if days == 24:
-                begin = today - timedelta(hours=days - 1)
-                return stats.time_series(begin, today + timedelta(hours=1), interval)
-
-            begin = today - timedelta(days=days - 1)
-            return stats.time_series(begin, today + timedelta(days=1), interval)
+            return get_admission(conf_data, get_queryset)
+        except (LookupError, FieldError, TypeError):
+            # reported when computed
+            return ADMIT
+
+    def refuse_registrations(self, conf_data, admission, interval, days):
+        """ Returns empty rows for a graph which can't be computed now
+        (too expensive or database busy), and tells why in the module """
+        if admission == REFUSE:
+            self.pre_content = _("This graph is too expensive to be drawn: add an index on its date field, "
+                                 "or restrict it with criteria.")
+        elif admission == BUSY:
+            self.pre_content = _("The database is busy, this graph will be drawn later.")
+        else:
+            self.pre_content = _("This graph is being computed, it will be drawn shortly.")
+        if conf_data is None:
+            begin, end = self.get_time_range(days)
+            return empty_time_series([default_aggregate()], begin, end, interval)
+        begin, end = self.get_query_range(conf_data, days)
+        return empty_time_series([aggregate for name, aggregate in conf_data.get_metrics()], begin, end, interval)
+
+    def compute_registrations(self, conf_data, user, interval, days, select_box_value):
+        """ Computes the rows of ``get_registrations`` from the database.
+
+        The rows of a graph broken down by a field hold the first metric of
+        its top values and of the other ones, whose names are cached with
+        the rows. """
+        begin, end = self.get_time_range(days)
+        try:
+            if conf_data is None:
+                raise LookupError("Graph '%s' doesn't exist" % self.graph_key)
+            begin, end = self.get_query_range(conf_data, days)
+            scope = get_user_scope(conf_data, user)
+            user_filter = user if scope != ALL_USERS else None
+            aggregates = [aggregate for name, aggregate in conf_data.get_metrics()]
+            if conf_data.group_by_field_name:
+                groups, rows = breakdown_time_series(
+                    self.get_queryset(conf_data, select_box_value, user_filter), conf_data.date_field_name,
+                    aggregates[0], begin, end, interval, conf_data.group_by_field_name, conf_data.group_by_limit,
+                    databases=conf_data.get_databases())
+                set_breakdown_groups(breakdown_cache_key(self.graph_key, interval, days, select_box_value, scope),
+                                     [force_text(group) for group in groups])
+                return rows
+            rows = time_series(self.get_queryset(conf_data, select_box_value, user_filter),
+                               conf_data.date_field_name, aggregates, begin, end, interval,
+                               databases=conf_data.get_databases())
+            if user_filter is None:
+                seed_counters(conf_data, interval, select_box_value, rows)
+            return rows
         except (LookupError, FieldError, TypeError) as e:
             self.error_message = str(e)
-            User = get_user_model()
-            stats = QuerySetStats(
-                User.objects.filter(is_active=True), 'date_joined')
-            today = now()
-            if days == 24:
-                begin = today - timedelta(hours=days - 1)
-                return stats.time_series(begin, today + timedelta(hours=1), interval)
-            begin = today - timedelta(days=days - 1)
-            return stats.time_series(begin, today + timedelta(days=1), interval)
-
-    @cached(60 * 5)
+            instrumentation.add('errors')
+            return empty_time_series([default_aggregate()], begin, end, interval)
+
+    def precompute_user_series(self, conf_data, interval, days, select_box_value):
+        """ Computes the rows of every user with one query grouped by user
+        and fans them out into per-user cache entries.
+
+        Returns the rows by user pk, or an empty dict if the configuration
+        is broken (the error is reported when computing the user rows)."""
+        begin, end = self.get_query_range(conf_data, days)
+        aggregates = [aggregate for name, aggregate in conf_data.get_metrics()]
+        try:
+            series = grouped_time_series(self.get_queryset(conf_data, select_box_value),
+                                         conf_data.date_field_name, aggregates, begin, end,
+                                         interval, group_by=conf_data.user_field_name,
+                                         databases=conf_data.get_databases())
+        except (LookupError, FieldError, TypeError):
+            return {}
+
+        series.pop(None, None)
+        cache_data = dict(
+            (series_cache_key(conf_data.graph_key, interval, days, select_box_value, user_pk), rows)
+            for user_pk, rows in series.items()
+        )
+        no_data_key = series_cache_key(conf_data.graph_key, interval, days, select_box_value, NO_DATA_USERS)
+        cache_data[no_data_key] = empty_time_series(aggregates, begin, end, interval)
+        # the dashboard is shown to staff users only
+        staff = get_user_model()._default_manager.filter(is_staff=True).values_list('pk', flat=True)
+        set_series_many(cache_data, no_data_users={no_data_key: set(staff) - set(series)})
+        return series
+
+    def refresh_series(self, conf_data, select_box_value):
+        """ Recomputes the rows of the graph and stores them in the cache,
+        including the per-user rows if they are precomputed """
+        rows = self.compute_registrations(conf_data, None, self.interval, self.days, select_box_value)
+        key = series_cache_key(conf_data.graph_key, self.interval, self.days, select_box_value, ALL_USERS)
+        set_series_many({key: rows})
+        if conf_data.transform == 'cumulative' and not conf_data.group_by_field_name:
+            self.store_baseline(conf_data, None, self.days, select_box_value)
+        if conf_data.user_field_name and conf_data.precompute_user_series and not conf_data.group_by_field_name:
+            self.precompute_user_series(conf_data, self.interval, self.days, select_box_value)
+
+    def split_previous_period(self, rows):
+        """ Splits rows covering two periods into the current period rows
+        and the rows of the previous period matched by index (None if
+        missing).
+
+        The rows hold the buckets of the previous period, as many buckets
+        of the current period and at most one more, which the range ends in
+        (see ``get_query_range``). """
+        count = len(rows) // 2
+        return rows[count:], rows[:count] + [None] * (len(rows) % 2)
+
     def prepare_template_data(self, data, graph_key, select_box_value, other_select_box_values):
         """ Prepares data for template (passed as module attributes) """
         self.extra = {
@@ -158,26 +499,123 @@ class DashboardChart(modules.DashboardModule):
         if self.interval in self.interval_dateformat_map:
             self.tooltip_date_format, self.extra['x_axis_format'] = self.interval_dateformat_map[self.interval]
 
-        self.chart_container = self.interval + '_' + self.graph_key
-        # add string into href attr
-        self.id = self.chart_container
-
-        xdata = []
-        ydata = []
-        for data_date in self.data:
-            start_time = int(time.mktime(data_date[0].timetuple()) * 1000)
-            xdata.append(start_time)
-            ydata.append(data_date[1])
+        conf_data = self.get_conf_data()
+        if conf_data and conf_data.group_by_field_name:
+            series_names = self.breakdown_names or []
+        else:
+            series_names = [name for name, aggregate in conf_data.get_metrics()] if conf_data else []
+        serie_count = len(self.data[0]) - 1 if self.data else 1
+        if serie_count == 1 or len(series_names) != serie_count:
+            series_names = [self.interval] * serie_count
+
+        rows = self.data
+        previous_rows = None
+        if conf_data and conf_data.compare_previous_period and rows:
+            rows, previous_rows = self.split_previous_period(rows)
+
+        series = [(series_names[i], [row[i + 1] for row in rows]) for i in range(serie_count)]
+        if previous_rows is not None:
+            series += [
+                ("%s (%s)" % (series_names[i], _('previous period')),
+                 [row[i + 1] if row else 0 for row in previous_rows])
+                for i in range(serie_count)
+            ]
+
+        xdata = [int(time.mktime(row[0].timetuple()) * 1000) for row in rows]
 
         extra_serie = {"tooltip": {"y_start": "", "y_end": ""},
                        "date_format": self.tooltip_date_format}
 
-        self.values = {
-            'x': xdata,
-            'name1': self.interval, 'y1': ydata, 'extra1': extra_serie,
-        }
+        self.values = {'x': xdata}
+        for i, (name, ydata) in enumerate(series):
+            self.values['name%d' % (i + 1)] = name
+            self.values['y%d' % (i + 1)] = ydata
+            self.values['extra%d' % (i + 1)] = extra_serie
+
+        if len(series) > 1 and self.chart_type == 'discreteBarChart':
+            # discreteBarChart draws only one serie
+            self.chart_type = 'multiBarChart'
+
+        self.form_field = self.get_criteria_field(graph_key, select_box_value, other_select_box_values)
+
+
+class DashboardHeatmap(DashboardChart):
+    """Dashboard module drawing the first metric of a graph by day of the
+    week and hour of the day, over the last ``days`` (4 weeks by default).
+
+    The 7 x 24 matrix is computed by one grouped query, with the criteria
+    and user filters of the charts, and cached like their series.
+    """
+    interval = 'heatmap'
+    days = 7 * 4
+    fragment_template = 'admin_tools_stats/modules/heatmap_fragment.html'
+    batch_series = False
+
+    def get_data(self, user):
+        conf_data = self.get_conf_data()
+        scope = get_user_scope(conf_data, user)
+        key = series_cache_key(self.graph_key, self.interval, self.days, self.select_box_value, scope)
+        cached = get_series_many([key]).get(key)
+        if cached is not None and cached[1]:
+            return cached[0]
+        admission = self.get_admission(conf_data)
+        if admission == BACKGROUND:
+            DashboardStatsJob.enqueue(self.graph_key, self.interval, self.days, self.select_box_value,
+                                      user if scope != ALL_USERS else None)
+            if cached is not None:
+                self.stale = True
+                return cached[0]
+        if admission != ADMIT:
+            return self.refuse_registrations(conf_data, admission, self.interval, self.days)
+        with query_slot(wait=cached is None) as acquired:
+            if not acquired:
+                return self.get_stale_registrations(cached[0] if cached else None, conf_data, self.interval,
+                                                    self.days)
+            return self.store_registrations(conf_data, user, self.interval, self.days, self.graph_key,
+                                            self.select_box_value)
+
+    def store_registrations(self, conf_data, user, interval, days, graph_key, select_box_value):
+        """ Computes the matrix of ``get_data`` and caches it """
+        self.select_box_value = select_box_value
+        matrix = self.compute_heatmap(conf_data, user)
+        if not hasattr(self, 'error_message'):
+            scope = get_user_scope(conf_data, user)
+            set_series_many({series_cache_key(graph_key, interval, days, select_box_value, scope): matrix})
+        return matrix
+
+    def compute_heatmap(self, conf_data, user):
+        """ Computes the matrix of ``get_data`` from the database """
+        try:
+            if conf_data is None:
+                raise LookupError("Graph '%s' doesn't exist" % self.graph_key)
+            begin, end = self.get_time_range(self.days)
+            user_filter = user if get_user_scope(conf_data, user) != ALL_USERS else None
+            return heatmap(self.get_queryset(conf_data, self.select_box_value, user_filter),
+                           conf_data.date_field_name, conf_data.get_metrics()[0][1], begin, end,
+                           databases=conf_data.get_databases())
+        except (LookupError, FieldError, TypeError) as e:
+            self.error_message = str(e)
+            instrumentation.add('errors')
+            return empty_heatmap()
 
-        self.form_field = get_dynamic_criteria(graph_key, select_box_value, other_select_box_values)
+    def refuse_registrations(self, conf_data, admission, interval, days):
+        super(DashboardHeatmap, self).refuse_registrations(conf_data, admission, 'days', days)
+        return empty_heatmap()
+
+    def refresh_series(self, conf_data, select_box_value):
+        self.select_box_value = select_box_value
+        key = series_cache_key(conf_data.graph_key, self.interval, self.days, select_box_value, ALL_USERS)
+        set_series_many({key: self.compute_heatmap(conf_data, None)})
+
+    def prepare_template_data(self, data, graph_key, select_box_value, other_select_box_values):
+        """ Prepares the heatmap cells, with their opacity: their share of the peak value """
+        peak = max(float(value or 0) for row in data for value in row) or 1
+        self.hours = range(24)
+        self.rows = [
+            (WEEKDAYS_ABBR[day], [(value or 0, '%.2f' % (float(value or 0) / peak)) for value in row])
+            for day, row in enumerate(data)
+        ]
+        self.form_field = self.get_criteria_field(graph_key, select_box_value, other_select_box_values)
 
 
 @cached(60 * 5)
@@ -190,32 +628,58 @@ def get_title(graph_key):
         return ''
 
 
+def get_dashboard_stats(graph_key):
+    """Returns graph configuration with its criteria and metrics, None if
+    missing. Cached until the graph changes (see ``expire_graph``)."""
+    key = dashboard_stats_cache_key(graph_key)
+    conf_data = cache.get(key)
+    if conf_data is None:
+        try:
+            conf_data = DashboardStats.objects.prefetch_related('criteria', 'metrics').get(graph_key=graph_key)
+        except DashboardStats.DoesNotExist:
+            return None
+        cache.set(key, conf_data, 60 * 5)
+    return conf_data
+
+
 @cached(60 * 5)
 def get_dynamic_criteria(graph_key, select_box_value, other_select_box_values):
     """To get dynamic criteria & return into select box to display on dashboard"""
     try:
-        temp = ''
-        conf_data = DashboardStats.objects.get(graph_key=graph_key).criteria.all()
-        for i in conf_data:
-            dy_map = i.criteria_dynamic_mapping
-            if dy_map:
-                temp = '<select name="select_box_' + graph_key + '" onChange="$(this).closest(\'form\').submit();">'
-                for key in dict(dy_map):
-                    value = dy_map[key]
-                    if key == select_box_value:
-                        temp += '<option value="' + key + '" selected=selected>' + value + '</option>'
-                    else:
-                        temp += '<option value="' + key + '">' + value + '</option>'
-                temp += '</select>'
-
-        temp += "\n".join(['<input type="hidden" name="%s" value="%s">' % (key, other_select_box_values[key]) for key in other_select_box_values ])
-
-        return mark_safe(force_text(temp))
+        graph = DashboardStats.objects.get(graph_key=graph_key)
+        return render_dynamic_criteria(graph, select_box_value, other_select_box_values)
     except LookupError as e:
         self.error_message = str(e)
         return ''
 
 
+def render_dynamic_criteria(graph, select_box_value, other_select_box_values):
+    """Returns the select boxes of the dynamic criteria of ``graph``, without
+    querying the database when its criteria are prefetched"""
+    graph_key = graph.graph_key
+    temp = ''
+    for i in graph.criteria.all():
+        dy_map = graph.get_dynamic_mapping(i)
+        if dy_map:
+            temp = '<select name="select_box_' + graph_key + '" class="admin-tools-stats-criteria"' \
+                   ' data-graph-key="' + graph_key + '">'
+            for key in dict(dy_map):
+                # discovered values come from the records
+                value = conditional_escape(dy_map[key])
+                option = conditional_escape(key)
+                if key == select_box_value:
+                    temp += '<option value="' + option + '" selected=selected>' + value + '</option>'
+                else:
+                    temp += '<option value="' + option + '">' + value + '</option>'
+            temp += '</select>'
+
+    # the other values come from the cookies
+    temp += format_html_join("\n", '<input type="hidden" name="{}" value="{}">',
+                             ((key, other_select_box_values[key]) for key in other_select_box_values))
+
+    return mark_safe(force_text(temp))
+
+
 def get_active_graph():
     """Returns active graphs"""
     try:
@@ -240,6 +704,45 @@ class DashboardCharts(modules.Group):
 
     def __init__(self, *args, **kwargs):
         key_value = kwargs.get('graph_key')
-        self.title = get_title(key_value)
-        kwargs.setdefault('children', self.get_registration_charts(**kwargs))
+        self.graph_key = key_value
+        if kwargs.get('batch') is not None:
+            conf_data = kwargs['batch'].get_conf_data(key_value)
+        else:
+            conf_data = get_dashboard_stats(key_value)
+        self.title = conf_data.graph_title if conf_data else ''
+        if 'children' not in kwargs:
+            children = self.get_registration_charts(**kwargs)
+            if conf_data is not None and conf_data.draw_heatmap:
+                children.append(DashboardHeatmap(_('by day and hour').title(), **kwargs))
+            kwargs['children'] = children
         super(DashboardCharts, self).__init__(*args, **kwargs)
+
+    @profiled
+    def init_with_context(self, context):
+        super(DashboardCharts, self).init_with_context(context)
+
+
+def get_dashboard_charts(context, **kwargs):
+    """Returns a ``DashboardCharts`` module for every visible graph.
+
+    All the charts share one ``DashboardStatsBatch``: the graphs configuration
+    is loaded once, and the series of every chart are fetched together, with
+    one query for the charts aggregating the same records::
+
+        self.children.extend(get_dashboard_charts(context, require_chart_jscss=True))
+    """
+    request = context['request']
+    batch = DashboardStatsBatch(get_active_graph())
+    kwargs.setdefault('require_chart_jscss', False)
+    # criteria selected on the dashboard are kept in cookies
+    select_box_values = dict(
+        (key, unquote(request.COOKIES[key])) for key in request.COOKIES if key.startswith('select_box_')
+    )
+    select_box_values.update(
+        (key, request.POST[key]) for key in request.POST if key.startswith('select_box_')
+    )
+    charts = []
+    for conf_data in batch.graphs:
+        chart_kwargs = dict(kwargs, graph_key=conf_data.graph_key, batch=batch, **select_box_values)
+        charts.append(DashboardCharts(**chart_kwargs))
+    return charts
@@ -0,0 +1,126 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2014 Star2Billing S.L.
+#
+# The Initial Developer of the Original Code is
+# Arezqui Belaid <info@star2billing.com>
+#
+"""
+Compact storage of the series in the cache.
+
+The rows of a serie are ``(date, value, ...)`` tuples, one per bucket. They
+are cached as the first date and the interval of the buckets, followed by
+one packed array per column: 64-bit integers if all its values are
+integers, doubles otherwise (None stored as NaN, decimals as floats). The
+arrays are compressed by zlib above ``SERIES_COMPRESS_THRESHOLD`` bytes.
+"""
+import math
+import sys
+import zlib
+from array import array
+from datetime import datetime
+from decimal import Decimal
+
+from dateutil.relativedelta import relativedelta
+from six import integer_types
+
+from admin_tools_stats.app_settings import get_setting
+
+# marks the packed rows, with the version of the format
+PACKED = 'admin_tools_stats:packed:1'
+INTERVALS = ('hours', 'days', 'weeks', 'months')
+FLOAT = 'd'
+try:
+    array('q')
+    INTEGER = 'q'
+except ValueError:  # Python 2
+    INTEGER = 'l'
+INTEGER_LIMIT = 2 ** (array(INTEGER).itemsize * 8 - 1)
+
+
+def get_dates(start, interval, count):
+    """Returns the ``count`` bucket dates from ``start``, like ``get_buckets``"""
+    step = relativedelta(**{interval: 1})
+    dates = []
+    dt = start
+    for i in range(count):
+        dates.append(dt)
+        dt = dt + step
+    return dates
+
+
+def find_interval(dates):
+    """Returns the interval between the consecutive ``dates``, None if irregular"""
+    for interval in INTERVALS:
+        # the first step rules out the other intervals quickly
+        if get_dates(dates[0], interval, min(len(dates), 2)) == dates[:2] and \
+                get_dates(dates[0], interval, len(dates)) == dates:
+            return interval
+    return None
+
+
+def get_typecode(values):
+    """Returns the array typecode storing ``values``, None if they aren't numbers"""
+    if all(isinstance(value, integer_types) and -INTEGER_LIMIT <= value < INTEGER_LIMIT for value in values):
+        return INTEGER
+    if all(value is None or isinstance(value, integer_types + (float, Decimal)) for value in values):
+        return FLOAT
+    return None
+
+
+def pack_rows(rows):
+    """Returns ``rows`` packed, or unchanged if they can't be (not buckets
+    of an interval, values other than numbers)"""
+    if not rows or not isinstance(rows[0][0], datetime) or len(set(len(row) for row in rows)) != 1:
+        return rows
+    interval = find_interval([row[0] for row in rows])
+    if interval is None:
+        return rows
+    typecodes = ''
+    data = []
+    for i in range(1, len(rows[0])):
+        values = [row[i] for row in rows]
+        typecode = get_typecode(values)
+        if typecode is None:
+            return rows
+        if typecode == FLOAT:
+            values = [float('nan') if value is None else float(value) for value in values]
+        column = array(typecode, values)
+        typecodes += typecode
+        data.append(column.tobytes() if hasattr(column, 'tobytes') else column.tostring())
+    data = b''.join(data)
+    threshold = get_setting('SERIES_COMPRESS_THRESHOLD')
+    compressed = threshold is not None and len(data) > threshold
+    if compressed:
+        data = zlib.compress(data)
+    return (PACKED, rows[0][0], interval, len(rows), typecodes, sys.byteorder, compressed, data)
+
+
+def unpack_rows(value):
+    """Returns the rows packed by ``pack_rows``, ``value`` itself if not packed"""
+    if not isinstance(value, tuple) or not value or value[0] != PACKED:
+        return value
+    marker, start, interval, count, typecodes, byteorder, compressed, data = value
+    if compressed:
+        data = zlib.decompress(data)
+    columns = []
+    offset = 0
+    for typecode in typecodes:
+        column = array(typecode)
+        size = column.itemsize * count
+        if hasattr(column, 'frombytes'):
+            column.frombytes(data[offset:offset + size])
+        else:
+            column.fromstring(data[offset:offset + size])
+        if byteorder != sys.byteorder:
+            column.byteswap()
+        offset += size
+        if typecode == FLOAT:
+            columns.append([None if math.isnan(item) else item for item in column])
+        else:
+            columns.append(column.tolist())
+    dates = get_dates(start, interval, count)
+    return [(dates[i],) + tuple(column[i] for column in columns) for i in range(count)]
@@ -0,0 +1,217 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2014 Star2Billing S.L.
+#
+# The Initial Developer of the Original Code is
+# Arezqui Belaid <info@star2billing.com>
+#
+"""Opt-in profiler of the dashboard rendering.
+
+With ``DashboardProfilerMiddleware`` installed, a superuser adds
+``?admin_tools_stats_profile=1`` to the admin index URL (or sends the
+``X-Admin-Tools-Stats-Profile: 1`` header) to get, instead of the page, a
+report of its rendering: the time and queries of every dashboard module,
+the SQL statements with their duration and the slowest functions
+(cProfile). ``download`` instead of ``1`` downloads the report, ``pstats``
+downloads the cProfile statistics (for snakeviz and the like), ``memory``
+adds the memory peak and largest allocations (tracemalloc, Python 3) to the
+report.
+
+Only the queries of the request thread are recorded. tracemalloc slows
+down the whole process and traces it: the allocations of concurrent
+requests are included.
+"""
+import cProfile
+import marshal
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.db import connections
+from django.http import HttpResponse
+from django.test.utils import CaptureQueriesContext
+from six import StringIO
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+PROFILE_PARAMETER = 'admin_tools_stats_profile'
+PROFILE_HEADER = 'HTTP_X_ADMIN_TOOLS_STATS_PROFILE'
+# functions of the cProfile statistics and allocations in the report
+PROFILE_FUNCTIONS = 40
+PROFILE_ALLOCATIONS = 20
+
+_local = threading.local()
+
+
+def get_current_profile():
+    """Returns the profile of the request being rendered, None if not profiled"""
+    return getattr(_local, 'profile', None)
+
+
+@contextmanager
+def profile_module(module):
+    """Records the time and queries of a dashboard module in the current profile"""
+    profile = get_current_profile()
+    if profile is None:
+        yield
+        return
+    entry = [profile.depth, module, 0, profile.get_query_count()]
+    profile.modules.append(entry)
+    profile.depth += 1
+    started = time.time()
+    try:
+        yield
+    finally:
+        profile.depth -= 1
+        entry[2] = time.time() - started
+        entry[3] = profile.get_query_count() - entry[3]
+
+
+def profiled(method):
+    """Decorates a method of dashboard modules, see ``profile_module``"""
+    @wraps(method)
+    def wrapper(module, *args, **kwargs):
+        with profile_module(module):
+            return method(module, *args, **kwargs)
+    return wrapper
+
+
+class QueryLog(object):
+    """Records the statements run on a connection with their duration"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.queries = []
+        if hasattr(connection, 'execute_wrapper'):
+            self.context = connection.execute_wrapper(self)
+        else:  # Django<2.0, durations in milliseconds
+            self.context = CaptureQueriesContext(connection)
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.time()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((sql, time.time() - started))
+
+    def __len__(self):
+        if isinstance(self.context, CaptureQueriesContext):
+            return len(self.context)
+        return len(self.queries)
+
+    def __enter__(self):
+        self.context.__enter__()
+
+    def __exit__(self, *args):
+        self.context.__exit__(*args)
+        if isinstance(self.context, CaptureQueriesContext):
+            self.queries = [(query['sql'], float(query['time'])) for query in self.context]
+
+
+class DashboardProfile(object):
+    """Time, queries and memory (if ``memory``) of a request, see
+    ``profile_module``"""
+
+    def __init__(self, memory=False):
+        self.modules = []
+        self.depth = 0
+        self.queries = [QueryLog(connections[alias]) for alias in connections]
+        self.profiler = cProfile.Profile()
+        self.elapsed = None
+        self.memory = memory
+        self.memory_peak = None
+        self.allocations = []
+
+    def get_query_count(self):
+        return sum(len(queries) for queries in self.queries)
+
+    def run(self, function, *args):
+        """Returns ``function(*args)``, profiled"""
+        tracing = self.memory and tracemalloc is not None and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        for queries in self.queries:
+            queries.__enter__()
+        _local.profile = self
+        started = time.time()
+        self.profiler.enable()
+        try:
+            return function(*args)
+        finally:
+            self.profiler.disable()
+            self.elapsed = time.time() - started
+            _local.profile = None
+            for queries in self.queries:
+                queries.__exit__(None, None, None)
+            if tracing:
+                self.memory_peak = tracemalloc.get_traced_memory()[1]
+                self.allocations = tracemalloc.take_snapshot().statistics('lineno')[:PROFILE_ALLOCATIONS]
+                tracemalloc.stop()
+
+    def get_stats(self):
+        """Returns the cProfile statistics, marshalled like ``pstats.Stats.dump_stats``"""
+        self.profiler.create_stats()
+        return marshal.dumps(self.profiler.stats)
+
+    def get_report(self, request):
+        queries = [(log.connection.alias, sql, duration) for log in self.queries for sql, duration in log.queries]
+        lines = ["Profile of %s %s: %.3fs, %d queries in %.3fs" % (
+            request.method, request.get_full_path(), self.elapsed, len(queries),
+            sum(duration for alias, sql, duration in queries))]
+        if self.memory_peak is not None:
+            lines.append("memory peak: %.1f KiB" % (self.memory_peak / 1024.0))
+
+        lines += ["", "Dashboard modules%s seconds  queries" % (' ' * 55)]
+        for depth, module, elapsed, query_count in self.modules:
+            name = '%s%s %s %s' % ('  ' * depth, module.__class__.__name__, getattr(module, 'graph_key', ''),
+                                   getattr(module, 'interval', ''))
+            lines.append("%-72s %7.3f %8d" % (name.rstrip(), elapsed, query_count))
+
+        lines += ["", "SQL statements (alias, milliseconds, statement)"]
+        for alias, sql, duration in queries:
+            lines.append("%s %8.2f  %s" % (alias, duration * 1000, sql))
+
+        if self.allocations:
+            lines += ["", "Largest allocations"]
+            lines += [str(statistic) for statistic in self.allocations]
+
+        stream = StringIO()
+        stats = pstats.Stats(self.profiler, stream=stream)
+        stats.sort_stats('cumulative').print_stats(PROFILE_FUNCTIONS)
+        lines += ["", "Functions (cProfile)", stream.getvalue()]
+        return "\n".join(lines)
+
+
+class DashboardProfilerMiddleware(object):
+    """Returns the profile of the request instead of its response, for the
+    superusers asking for it (see the module documentation). To be added to
+    ``MIDDLEWARE`` after ``AuthenticationMiddleware``."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        mode = request.GET.get(PROFILE_PARAMETER) or request.META.get(PROFILE_HEADER)
+        user = getattr(request, 'user', None)
+        if not mode or user is None or not user.is_superuser:
+            return self.get_response(request)
+
+        profile = DashboardProfile(memory=mode == 'memory')
+        response = profile.run(self.get_response, request)
+        if getattr(response, 'streaming', False):
+            return response
+        if mode == 'pstats':
+            response = HttpResponse(profile.get_stats(), content_type='application/octet-stream')
+            response['Content-Disposition'] = 'attachment; filename="dashboard.prof"'
+            return response
+        response = HttpResponse(profile.get_report(request), content_type='text/plain; charset=utf-8')
+        if mode == 'download':
+            response['Content-Disposition'] = 'attachment; filename="dashboard-profile.txt"'
+        return response
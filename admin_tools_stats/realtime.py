@@ -0,0 +1,355 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2014 Star2Billing S.L.
+#
+# The Initial Developer of the Original Code is
+# Arezqui Belaid <info@star2billing.com>
+#
+"""Real-time counters of the current bucket of the graphs.
+
+Graphs with ``realtime_counters`` keep the count of the records and the sums
+of their summed fields of the current bucket (hour, day, week and month) in
+cache counters, for every criteria value. The counters are seeded when the
+serie is computed, then updated by the ``post_save``/``post_delete`` signals
+of the model, and replace the current bucket of the cached series when the
+charts are drawn, so the hot bucket is served without any query.
+
+The receivers of the signals are connected to the models of the realtime
+graphs only, which every process reads again when a request starts, at most
+every ``REALTIME_GRAPHS_TIMEOUT`` seconds: the counters of a graph are seeded
+that long after it is registered, once every process counts its records.
+Records saved outside of requests (ex. by commands) are counted by the
+processes which loaded the realtime graphs (see ``RealtimeGraphs.load``).
+
+Counters are kept only when they can be maintained exactly: every metric
+is a Count or a Sum of a field of the model, criteria are exact lookups on
+the model fields and summed values are integers. An updated record expires
+the counters of the graph, which are seeded again by the next computation.
+"""
+import threading
+import time
+from datetime import datetime
+from decimal import Decimal
+
+from dateutil.relativedelta import relativedelta
+from django.apps import apps
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+try:
+    from django.core.exceptions import FieldDoesNotExist
+except ImportError:  # Django < 1.8
+    from django.db.models.fields import FieldDoesNotExist
+from django.db.models import Count, Model, Sum
+from django.db.models.signals import post_delete, post_save
+from django.utils.timezone import now
+from qsstats.utils import get_bounds
+from six import integer_types
+
+from admin_tools_stats.app_settings import get_setting
+from admin_tools_stats.cache import REALTIME_GRAPHS_KEY, criteria_hash, realtime_graph_key
+
+INTERVALS = ('hours', 'days', 'weeks', 'months')
+
+
+def get_counter_names(conf_data):
+    """Returns the counter of every metric of the graph, None if one of them
+    can't be counted in real time"""
+    if '__' in conf_data.date_field_name or conf_data.group_by_field_name:
+        return None
+    names = []
+    for name, aggregate in conf_data.get_metrics():
+        expressions = aggregate.get_source_expressions()
+        field_name = getattr(expressions[0], 'name', None) if expressions else None
+        if field_name is None or '__' in field_name:
+            return None
+        if isinstance(aggregate, Count):
+            if getattr(aggregate, 'distinct', False) and field_name != 'pk':
+                return None
+            names.append('count' if field_name == 'pk' else 'count:%s' % field_name)
+        elif isinstance(aggregate, Sum):
+            names.append('sum:%s' % field_name)
+        else:
+            return None
+    return names
+
+
+def get_bucket(dt, interval):
+    return get_bounds(dt, interval.rstrip('s'))[0]
+
+
+def counter_key(graph_key, interval, select_box_value, bucket, name):
+    return 'admin_tools_stats:counter:%s:%s:%s:%s:%s' % (
+        graph_key, interval, criteria_hash(select_box_value),
+        bucket.strftime('%Y%m%d%H'), name,
+    )
+
+
+def counter_timeout(interval):
+    """Counters last until the next bucket is over"""
+    bucket_start = get_bucket(now(), interval)
+    next_end = bucket_start + relativedelta(**{interval: 2})
+    return int((next_end - bucket_start).total_seconds())
+
+
+def to_counter_value(value):
+    """Returns the integer added to a counter, None if ``value`` isn't one"""
+    if value is None:
+        return 0
+    if isinstance(value, (bool,) + integer_types):
+        return int(value)
+    if isinstance(value, (float, Decimal)) and value == int(value):
+        return int(value)
+    return None
+
+
+def get_model_key(app_label, model_name):
+    return app_label.lower(), model_name.lower()
+
+
+def get_configured_graphs():
+    """Returns the visible graphs with realtime counters, by (app, model) name"""
+    from admin_tools_stats.models import DashboardStats
+    graphs = {}
+    for conf_data in DashboardStats.objects.filter(realtime_counters=True, is_visible=True) \
+            .prefetch_related('criteria', 'metrics'):
+        if get_counter_names(conf_data):
+            model_key = get_model_key(conf_data.model_app_name, conf_data.model_name)
+            graphs.setdefault(model_key, {})[conf_data.graph_key] = conf_data
+    return graphs
+
+
+class RealtimeGraphs(object):
+    """Realtime graphs of the process, by (app, model) name.
+
+    They are read from the cache, filled from the graph configurations when
+    missing, and the ``update_counters`` receivers are connected to the
+    signals of their models only.
+    """
+
+    def __init__(self):
+        self.graphs = {}
+        self.loaded_at = None
+        self.lock = threading.Lock()
+
+    def get(self, model_key):
+        return self.graphs.get(model_key)
+
+    def load(self, force=False):
+        """Reads the realtime graphs again, if they were read more than
+        ``REALTIME_GRAPHS_TIMEOUT`` seconds ago unless ``force``"""
+        timeout = get_setting('REALTIME_GRAPHS_TIMEOUT')
+        if not force and self.loaded_at is not None and time.time() < self.loaded_at + timeout:
+            return
+        graphs = cache.get(REALTIME_GRAPHS_KEY)
+        if graphs is None:
+            graphs = get_configured_graphs()
+            cache.add(REALTIME_GRAPHS_KEY, graphs, timeout)
+        with self.lock:
+            for model_key in set(self.graphs) - set(graphs):
+                self.connect(model_key, False)
+            for model_key in set(graphs) - set(self.graphs):
+                self.connect(model_key, True)
+            self.graphs = graphs
+            self.loaded_at = time.time()
+
+    def connect(self, model_key, connected):
+        try:
+            model = apps.get_model(*model_key)
+        except LookupError:
+            return
+        for signal, name in ((post_save, 'save'), (post_delete, 'delete')):
+            dispatch_uid = 'admin_tools_stats_realtime_%s_%s.%s' % ((name,) + model_key)
+            if connected:
+                signal.connect(update_counters, sender=model, dispatch_uid=dispatch_uid)
+            else:
+                signal.disconnect(sender=model, dispatch_uid=dispatch_uid)
+
+    def clear(self):
+        with self.lock:
+            for model_key in self.graphs:
+                self.connect(model_key, False)
+            self.graphs = {}
+            self.loaded_at = None
+
+
+realtime_graphs = RealtimeGraphs()
+
+
+def load_realtime_graphs(sender, **kwargs):
+    """Reads the realtime graphs of the process again when they are old,
+    receiver of the ``request_started`` signal"""
+    realtime_graphs.load()
+
+
+def register_realtime_graph(conf_data, keys, timeout):
+    """Registers the graph for the signals of its model.
+
+    Returns the time the graph was registered at. The counters of ``keys``,
+    left from before the registration, are deleted: they may have missed
+    records."""
+    key = realtime_graph_key(conf_data.graph_key)
+    registered_at = cache.get(key)
+    if registered_at is None:
+        registered_at = time.time()
+        if cache.add(key, registered_at, None):
+            delete_counters(keys, timeout)
+            # counted by this process right away
+            realtime_graphs.load(force=True)
+        else:
+            registered_at = cache.get(key, registered_at)
+    return registered_at
+
+
+def current_counter_keys(conf_data, interval, select_box_value, names):
+    bucket = get_bucket(now(), interval)
+    return [counter_key(conf_data.graph_key, interval, select_box_value, bucket, name) for name in names]
+
+
+def seed_counters(conf_data, interval, select_box_value, rows):
+    """Seeds the counters of the current bucket from freshly computed rows"""
+    names = get_counter_names(conf_data)
+    if not conf_data.realtime_counters or not names:
+        return
+    bucket = get_bucket(now(), interval)
+    keys = current_counter_keys(conf_data, interval, select_box_value, names)
+    timeout = counter_timeout(interval)
+    registered_at = register_realtime_graph(conf_data, keys, timeout)
+    if time.time() < registered_at + get_setting('REALTIME_GRAPHS_TIMEOUT'):
+        # records may not be counted by every process yet
+        return
+    for row in rows:
+        if row[0] == bucket:
+            values = [to_counter_value(value) for value in row[1:]]
+            if None not in values:
+                for key, value in zip(keys, values):
+                    cache.add(key, value, timeout)
+            break
+
+
+def merge_counters(conf_data, interval, select_box_value, rows):
+    """Returns ``rows`` with the current bucket read from the counters"""
+    names = get_counter_names(conf_data) if conf_data.realtime_counters else None
+    if not names or not rows:
+        return rows
+    keys = current_counter_keys(conf_data, interval, select_box_value, names)
+    counters = cache.get_many(keys)
+    if len(counters) != len(set(keys)):
+        return rows
+    bucket = get_bucket(now(), interval)
+    current_row = (bucket,) + tuple(counters[key] for key in keys)
+    return [current_row if row[0] == bucket else row for row in rows]
+
+
+def matches(instance, filter_kwargs):
+    """Returns whether ``instance`` matches ``filter_kwargs``, None if the
+    filter can't be evaluated without a query"""
+    for lookup, value in filter_kwargs.items():
+        field_name = lookup[:-len('__exact')] if lookup.endswith('__exact') else lookup
+        if '__' in field_name:
+            return None
+        try:
+            field = instance._meta.get_field(field_name)
+        except FieldDoesNotExist:
+            return None
+        if field.many_to_many or field.one_to_many:
+            return None
+        if isinstance(value, Model):
+            value = value.pk
+        try:
+            value = field.target_field.to_python(value) if field.is_relation else field.to_python(value)
+        except ValidationError:
+            return None
+        if getattr(instance, field.attname) != value:
+            return False
+    return True
+
+
+def get_deltas(instance, names):
+    """Returns the value added to every counter by ``instance``"""
+    deltas = []
+    for name in names:
+        if name == 'count':
+            deltas.append(1)
+        elif name.startswith('count:'):
+            deltas.append(0 if getattr(instance, name[len('count:'):]) is None else 1)
+        else:
+            deltas.append(to_counter_value(getattr(instance, name[len('sum:'):])))
+    return deltas
+
+
+def deleted_counter_key(key):
+    return key + ':deleted'
+
+
+def delete_counters(keys, timeout):
+    """Deletes the counters of ``keys``, which aren't counted again until
+    they are seeded from the series: the records they counted would be
+    missed if they restarted from zero"""
+    cache.delete_many(keys)
+    cache.set_many(dict((deleted_counter_key(key), True) for key in keys), timeout)
+
+
+def add_to_counter(key, previous_key, delta, timeout):
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        # first record of the bucket, counted from zero if the previous
+        # bucket was counted and the counter wasn't deleted
+        found = cache.get_many([previous_key, deleted_counter_key(key)])
+        if previous_key in found and deleted_counter_key(key) not in found:
+            cache.add(key, 0, timeout)
+            cache.incr(key, delta)
+
+
+def expire_counters(conf_data, names):
+    for interval in INTERVALS:
+        keys = []
+        for select_box_value in conf_data.get_select_box_values():
+            keys.extend(current_counter_keys(conf_data, interval, select_box_value, names))
+        delete_counters(keys, counter_timeout(interval))
+
+
+def update_counters(sender, instance, **kwargs):
+    """Counts the saved or deleted record, receiver of
+    ``post_save`` and ``post_delete`` signals"""
+    graphs = realtime_graphs.get(get_model_key(sender._meta.app_label, sender._meta.object_name))
+    if not graphs:
+        return
+    deleted = 'created' not in kwargs
+    for conf_data in graphs.values():
+        names = get_counter_names(conf_data)
+        if not names:
+            continue
+        date = getattr(instance, conf_data.date_field_name, None)
+        deltas = get_deltas(instance, names)
+        select_box_values = []
+        for select_box_value in conf_data.get_select_box_values():
+            match = matches(instance, conf_data.get_filter_kwargs(select_box_value))
+            if match is None:
+                select_box_values = None
+                break
+            if match:
+                select_box_values.append(select_box_value)
+        if not (deleted or kwargs['created']) or not isinstance(date, datetime) or \
+                None in deltas or select_box_values is None:
+            # updated records may have left the bucket or changed their values
+            expire_counters(conf_data, names)
+            continue
+
+        sign = -1 if deleted else 1
+        today = now()
+        for interval in INTERVALS:
+            bucket = get_bucket(today, interval)
+            if get_bucket(date, interval) != bucket:
+                continue
+            previous_bucket = get_bucket(bucket - relativedelta(**{interval: 1}), interval)
+            timeout = counter_timeout(interval)
+            for select_box_value in select_box_values:
+                for name, delta in zip(names, deltas):
+                    add_to_counter(
+                        counter_key(conf_data.graph_key, interval, select_box_value, bucket, name),
+                        counter_key(conf_data.graph_key, interval, select_box_value, previous_bucket, name),
+                        sign * delta, timeout)
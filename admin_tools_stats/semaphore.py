@@ -0,0 +1,133 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2014 Star2Billing S.L.
+#
+# The Initial Developer of the Original Code is
+# Arezqui Belaid <info@star2billing.com>
+#
+"""Bounds the number of stats queries running at once across processes.
+
+With ``ADMIN_TOOLS_STATS_MAX_CONCURRENT_QUERIES`` set, computing series
+requires one of that many slots. Slots are cache keys taken with the atomic
+``cache.add`` when the cache is shared between processes, or lock files
+when it is local to each process (single host). Requests without a free
+slot are served the stale series if any, or wait for a slot up to
+``ADMIN_TOOLS_STATS_QUERY_WAIT_TIMEOUT`` seconds.
+"""
+import os
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+from admin_tools_stats.app_settings import get_setting
+
+# reason of the series not computed, see ``DashboardChart.refuse_registrations``
+BUSY = 'busy'
+# seconds between two attempts to take a slot
+POLL_INTERVAL = 0.1
+
+
+class CacheSemaphore(object):
+    """Semaphore shared by the processes using the same cache.
+
+    Every slot is a cache key, taken with ``cache.add`` for ``lease``
+    seconds at most, in case its holder dies without releasing it. It holds
+    a token of its holder, so that a slot taken by another process once the
+    lease is over isn't released."""
+
+    def __init__(self, name, limit, lease):
+        self.keys = ['admin_tools_stats:semaphore:%s:%d' % (name, i) for i in range(limit)]
+        self.lease = lease
+        self.key = None
+        self.token = None
+
+    def acquire(self):
+        """Takes a free slot, returns False if there is none"""
+        token = uuid.uuid4().hex
+        for key in self.keys:
+            if cache.add(key, token, self.lease):
+                self.key = key
+                self.token = token
+                return True
+        return False
+
+    def release(self):
+        if cache.get(self.key) == self.token:
+            cache.delete(self.key)
+        self.key = None
+        self.token = None
+
+
+class FileSemaphore(object):
+    """Semaphore shared by the processes of the host.
+
+    Every slot is a lock file, released by the system if its holder dies."""
+
+    def __init__(self, name, limit, directory=None):
+        directory = directory or tempfile.gettempdir()
+        self.paths = [os.path.join(directory, 'admin_tools_stats-%s-%d.lock' % (name, i)) for i in range(limit)]
+        self.file = None
+
+    def acquire(self):
+        """Takes a free slot, returns False if there is none"""
+        for path in self.paths:
+            lock_file = open(path, 'a')
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                lock_file.close()
+                continue
+            self.file = lock_file
+            return True
+        return False
+
+    def release(self):
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.file.close()
+        self.file = None
+
+
+def get_query_semaphore():
+    """Returns the semaphore of the stats queries, None if they aren't bounded"""
+    limit = get_setting('MAX_CONCURRENT_QUERIES')
+    if limit is None:
+        return None
+    # ``cache`` is a proxy of the default cache
+    if isinstance(caches['default'], (LocMemCache, DummyCache)) and fcntl is not None:
+        return FileSemaphore('queries', limit)
+    return CacheSemaphore('queries', limit, get_setting('QUERY_LEASE_TIMEOUT'))
+
+
+@contextmanager
+def query_slot(wait=True):
+    """Holds a slot of the stats queries while the block runs.
+
+    Yields False if no slot was free, after waiting up to
+    ``QUERY_WAIT_TIMEOUT`` seconds if ``wait``."""
+    semaphore = get_query_semaphore()
+    if semaphore is None:
+        yield True
+        return
+    deadline = time.time() + (get_setting('QUERY_WAIT_TIMEOUT') if wait else 0)
+    acquired = semaphore.acquire()
+    while not acquired and time.time() < deadline:
+        time.sleep(POLL_INTERVAL)
+        acquired = semaphore.acquire()
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            semaphore.release()
@@ -0,0 +1,77 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2014 Star2Billing S.L.
+#
+# The Initial Developer of the Original Code is
+# Arezqui Belaid <info@star2billing.com>
+#
+import math
+
+
+class LogHistogram(object):
+    """Mergeable histogram with logarithmic bins, used to estimate percentiles.
+
+    Positive and negative values are counted in bins whose boundaries are
+    powers of ``gamma``, so that any estimated percentile is within
+    ``relative_accuracy`` of the real value. Bins don't depend on the data,
+    so histograms of different intervals (or databases) can be merged by
+    simply adding their counts.
+
+    Counts are stored by ``(sign, key)`` where ``sign`` is -1, 0 or 1 and
+    ``key`` is ``ceil(log(abs(value), gamma))``.
+    """
+
+    def __init__(self, relative_accuracy=0.01, counts=None):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.counts = dict(counts or {})
+
+    def get_key(self, value):
+        """Returns the ``(sign, key)`` bin of ``value``"""
+        if value > 0:
+            return 1, int(math.ceil(math.log(value, self.gamma)))
+        if value < 0:
+            return -1, int(math.ceil(math.log(-value, self.gamma)))
+        return 0, 0
+
+    def add(self, sign, key, count=1):
+        bin = (sign, key if sign else 0)
+        self.counts[bin] = self.counts.get(bin, 0) + count
+
+    def add_value(self, value, count=1):
+        sign, key = self.get_key(value)
+        self.add(sign, key, count)
+
+    def merge(self, other):
+        """Adds the counts of ``other`` histogram into this one"""
+        if other.gamma != self.gamma:
+            raise ValueError("Can't merge histograms of different accuracy")
+        for (sign, key), count in other.counts.items():
+            self.add(sign, key, count)
+        return self
+
+    @property
+    def count(self):
+        return sum(self.counts.values())
+
+    def bin_value(self, sign, key):
+        """Returns the value representing the ``(sign, key)`` bin"""
+        return sign * 2 * self.gamma ** key / (self.gamma + 1)
+
+    def quantile(self, q):
+        """Returns the estimated ``q`` quantile (0 <= q <= 1), None if empty"""
+        total = self.count
+        if not total:
+            return None
+        rank = q * (total - 1)
+        # negative values: the higher the key, the lower the value
+        ordered = sorted(self.counts, key=lambda bin: (bin[0], bin[0] * bin[1]))
+        seen = 0
+        for sign, key in ordered:
+            seen += self.counts[(sign, key)]
+            if seen > rank:
+                return self.bin_value(sign, key)
+        return self.bin_value(*ordered[-1])
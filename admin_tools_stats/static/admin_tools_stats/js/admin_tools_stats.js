@@ -0,0 +1,118 @@
+/*
+ * Registry of the dashboard charts.
+ *
+ * Every chart module registers the function drawing it. The charts are
+ * drawn once the page and the chart libraries are loaded, and only when
+ * their container becomes visible (tab shown or scrolled into view).
+ *
+ * Changing a criteria select box keeps the choice in a cookie and reloads
+ * only the charts of that graph, when they are visible; the whole form is
+ * submitted if the chart URLs aren't available.
+ */
+(function (window, document) {
+    if (window.adminToolsStats) {
+        return;
+    }
+
+    var charts = {};
+    var pending = [];
+    var started = false;
+    var observer = null;
+
+    function draw(id) {
+        var chart = charts[id];
+        if (chart && !chart.drawn) {
+            chart.drawn = true;
+            chart.draw();
+        }
+    }
+
+    function observe(id) {
+        var element = document.getElementById(id);
+        if (observer && element) {
+            observer.observe(element);
+        } else {
+            draw(id);
+        }
+    }
+
+    function start() {
+        if (started) {
+            return;
+        }
+        started = true;
+        if ('IntersectionObserver' in window) {
+            observer = new IntersectionObserver(function (entries) {
+                entries.forEach(function (entry) {
+                    if (entry.isIntersecting) {
+                        observer.unobserve(entry.target);
+                        draw(entry.target.id);
+                    }
+                });
+            });
+        }
+        pending.forEach(observe);
+        pending = [];
+    }
+
+    function load(wrapper, value) {
+        var id = wrapper.getAttribute('data-graph-key') + '-' + wrapper.getAttribute('data-url');
+        charts[id] = {
+            drawn: false,
+            draw: function () {
+                var url = wrapper.getAttribute('data-url') + '?select_box_value=' + encodeURIComponent(value);
+                window.jQuery.get(url, function (html) {
+                    window.jQuery(wrapper).html(html);
+                });
+            }
+        };
+        wrapper.id = id;
+        observe(id);
+    }
+
+    function changeCriteria(event) {
+        var select = event.target;
+        if (!select.classList || !select.classList.contains('admin-tools-stats-criteria')) {
+            return;
+        }
+        var graphKey = select.getAttribute('data-graph-key');
+        document.cookie = 'select_box_' + graphKey + '=' + encodeURIComponent(select.value) + '; path=/';
+
+        var wrappers = document.querySelectorAll('.admin-tools-stats-chart[data-graph-key="' + graphKey + '"]');
+        if (!window.jQuery || !wrappers.length || !wrappers[0].getAttribute('data-url')) {
+            select.form.submit();
+            return;
+        }
+        for (var i = 0; i < wrappers.length; i++) {
+            load(wrappers[i], select.value);
+        }
+    }
+
+    window.adminToolsStats = {
+        register: function (id, drawFunction) {
+            charts[id] = {draw: drawFunction, drawn: false};
+            if (started) {
+                observe(id);
+            } else {
+                pending.push(id);
+            }
+        },
+        redraw: function (id) {
+            var chart = charts[id];
+            if (chart) {
+                chart.drawn = false;
+                if (started) {
+                    observe(id);
+                }
+            }
+        }
+    };
+
+    document.addEventListener('change', changeCriteria);
+
+    if (document.readyState === 'complete') {
+        start();
+    } else {
+        window.addEventListener('load', start);
+    }
+})(window, document);
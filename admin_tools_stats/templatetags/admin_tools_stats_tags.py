@@ -0,0 +1,35 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2014 Star2Billing S.L.
+#
+# The Initial Developer of the Original Code is
+# Arezqui Belaid <info@star2billing.com>
+#
+from django import template
+
+register = template.Library()
+
+
+@register.inclusion_tag('admin_tools_stats/assets.html', takes_context=True)
+def admin_tools_stats_assets(context, require_chart_jscss=False):
+    """Includes the charts scripts and styles, only once per page.
+
+    **usage**:
+
+        {% admin_tools_stats_assets module.require_chart_jscss %}
+    """
+    request = context.get('request')
+    loaded = getattr(request, '_admin_tools_stats_assets', set())
+    assets = {
+        'include_registry': 'registry' not in loaded,
+        'include_libraries': require_chart_jscss and 'libraries' not in loaded,
+    }
+    loaded.add('registry')
+    if require_chart_jscss:
+        loaded.add('libraries')
+    if request is not None:
+        request._admin_tools_stats_assets = loaded
+    return assets
@@ -0,0 +1,25 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2014 Star2Billing S.L.
+#
+# The Initial Developer of the Original Code is
+# Arezqui Belaid <info@star2billing.com>
+#
+from django.conf.urls import url
+
+from admin_tools_stats import views
+try:
+    from admin_tools_stats import async_api
+except SyntaxError:  # Python 2
+    async_api = None
+
+urlpatterns = [
+    url(r'^chart/(?P<graph_key>[^/]+)/(?P<interval>\w+)/$', views.chart_data, name='admin_tools_stats_chart'),
+    url(r'^metrics/$', views.metrics, name='admin_tools_stats_metrics'),
+]
+
+if async_api is not None and async_api.ASYNC_VIEWS:
+    urlpatterns.append(url(r'^data/$', async_api.dashboard_data, name='admin_tools_stats_data'))
@@ -10,6 +10,7 @@
 #
 
 from django.contrib.auth.models import User
+from django.core.cache import caches
 from django.test import TestCase, Client
 from django.test.client import RequestFactory
 import base64
@@ -64,6 +65,66 @@ class BaseAuthenticatedClient(TestCase):
         self.factory = RequestFactory()
 
 
+class CountingCache(object):
+    """Counts the operations on the default cache while the block runs::
+
+        with CountingCache() as cache_operations:
+            response = self.client.get('/admin/')
+        self.assertLessEqual(cache_operations.count, 5)
+
+    ``calls`` holds the ``(method, key or keys)`` of every operation;
+    the operations made by the other ones (like ``get_many`` made of
+    ``get``) aren't counted. ``reads`` and ``hits`` count the keys read and
+    found.
+    """
+    methods = ('add', 'get', 'set', 'get_or_set', 'has_key', 'incr', 'decr',
+               'delete', 'get_many', 'set_many', 'delete_many', 'clear')
+
+    def __enter__(self):
+        self.calls = []
+        self.depth = 0
+        self.reads = 0
+        self.hits = 0
+        self.backend = caches['default']
+        for name in self.methods:
+            setattr(self.backend, name, self.wrap(name, getattr(self.backend, name)))
+        return self
+
+    def __exit__(self, *args):
+        for name in self.methods:
+            delattr(self.backend, name)
+
+    def wrap(self, name, method):
+        def counted(*args, **kwargs):
+            if not self.depth:
+                self.calls.append((name, args[0] if args else None))
+            self.depth += 1
+            try:
+                result = method(*args, **kwargs)
+            finally:
+                self.depth -= 1
+            if not self.depth:
+                self.count_hits(name, args, kwargs, result)
+            return result
+        return counted
+
+    def count_hits(self, name, args, kwargs, result):
+        if name == 'get_many':
+            self.reads += len(args[0])
+            self.hits += len(result)
+        elif name == 'get':
+            default = args[1] if len(args) > 1 else kwargs.get('default')
+            self.reads += 1
+            self.hits += result is not default
+        elif name == 'has_key':
+            self.reads += 1
+            self.hits += bool(result)
+
+    @property
+    def count(self):
+        return len(self.calls)
+
+
 class Choice(object):
 
     class __metaclass__(type):
@@ -0,0 +1,53 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2014 Star2Billing S.L.
+#
+# The Initial Developer of the Original Code is
+# Arezqui Belaid <info@star2billing.com>
+#
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import Http404, HttpResponse, HttpResponseForbidden
+from django.shortcuts import render
+from django.utils.crypto import constant_time_compare
+
+from admin_tools_stats.app_settings import get_setting
+from admin_tools_stats.exporter import CONTENT_TYPE, render_metrics
+from admin_tools_stats.modules import DashboardChart, DashboardHeatmap, get_active_graph, get_dashboard_stats
+
+
+@staff_member_required
+def chart_data(request, graph_key, interval):
+    """Renders one dashboard chart for the criteria value ``select_box_value``.
+
+    Called by the dashboard when a criteria is changed, to redraw the chart
+    without reloading the whole page."""
+    conf_data = get_dashboard_stats(graph_key)
+    if conf_data is None or not conf_data.is_visible:
+        raise Http404
+    kwargs = {'select_box_' + graph_key: request.GET.get('select_box_value', '')}
+    if interval == DashboardHeatmap.interval and conf_data.draw_heatmap:
+        module = DashboardHeatmap(graph_key=graph_key, require_chart_jscss=False, **kwargs)
+    elif interval in ('hours', 'days', 'weeks', 'months'):
+        module = DashboardChart(interval=interval, graph_key=graph_key, require_chart_jscss=False, **kwargs)
+    else:
+        raise Http404
+    module.init_with_context({'request': request})
+    return render(request, 'admin_tools_stats/modules/chart_content.html', {'module': module})
+
+
+def metrics(request):
+    """Publishes the latest values of the visible graphs and the counters
+    of the process in the Prometheus text format, see ``exporter``.
+
+    Allowed to the staff users, and to the scrapers sending the
+    ``ADMIN_TOOLS_STATS_METRICS_TOKEN`` as bearer token."""
+    token = get_setting('METRICS_TOKEN')
+    user = getattr(request, 'user', None)
+    if not (token and constant_time_compare(request.META.get('HTTP_AUTHORIZATION', ''), 'Bearer %s' % token)) \
+            and not (user is not None and user.is_active and user.is_staff):
+        return HttpResponseForbidden()
+    graphs = list(get_active_graph().prefetch_related('criteria', 'metrics'))
+    return HttpResponse(render_metrics(graphs), content_type=CONTENT_TYPE)
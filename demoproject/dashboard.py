@@ -18,7 +18,7 @@ except ImportError:  # Django<2.0
 
 from admin_tools.dashboard import modules, Dashboard, AppIndexDashboard
 from admin_tools.utils import get_admin_site_name
-from admin_tools_stats.modules import DashboardCharts, get_active_graph
+from admin_tools_stats.modules import get_dashboard_charts
 
 
 class CustomIndexDashboard(Dashboard):
@@ -73,17 +73,7 @@ class CustomIndexDashboard(Dashboard):
         # Copy following code into your custom dashboard
         # append following code after recent actions module or
         # a link list module for "quick links"
-        graph_list = get_active_graph()
-        for i in graph_list:
-            kwargs = {}
-            kwargs['require_chart_jscss'] = True
-            kwargs['graph_key'] = i.graph_key
-
-            for key in context['request'].POST:
-                if key.startswith('select_box_'):
-                    kwargs[key] = context['request'].POST[key]
-
-            self.children.append(DashboardCharts(**kwargs))
+        self.children.extend(get_dashboard_charts(context, require_chart_jscss=True))
 
         # append another link list module for "support".
         self.children.append(modules.LinkList(
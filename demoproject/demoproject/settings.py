@@ -147,7 +147,10 @@ MIDDLEWARE_CLASSES = (
     # Uncomment the next line for simple clickjacking protection:
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
-MIDDLEWARE = MIDDLEWARE_CLASSES
+MIDDLEWARE = MIDDLEWARE_CLASSES + (
+    # superusers profile the dashboard with ?admin_tools_stats_profile=1
+    'admin_tools_stats.profiling.DashboardProfilerMiddleware',
+)
 
 
 ROOT_URLCONF = 'demoproject.urls'
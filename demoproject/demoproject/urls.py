@@ -14,5 +14,6 @@ urlpatterns = [
     # url(r'^admin/doc/', include('django.contrib.admindocs.urls')),
 
     url(r'^admin_tools/', include('admin_tools.urls')),
+    url(r'^admin_tools_stats/', include('admin_tools_stats.urls')),
     url(r'^admin/', admin.site.urls),
 ]